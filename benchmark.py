@@ -0,0 +1,593 @@
+# benchmark.py
+"""
+离线基准测试：用本地模拟的微信读书和 Notion 服务运行 WeReadSync，
+统计每个接口的请求数、耗时和内存峰值，不需要真实的 Cookie 和 Token
+
+用法：
+    python benchmark.py --books 10 --runs 2
+    python benchmark.py --books 10000 --highlights 20 --mutate 0.01 --runs 2
+    python benchmark.py --books 200 --latency 0.05 --rate-429 0.02 --json report.json
+    python benchmark.py --books 200 --baseline report.json    # 请求数或内存比基线多出 10% 以上时退出码为 1
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import random
+import resource
+import argparse
+import tempfile
+import threading
+import tracemalloc
+import multiprocessing
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import httpx
+
+ROOT_PAGE_ID = "0123456789abcdef0123456789abcdef"
+BASE_TIME = 1_600_000_000
+WEREAD_HOSTS = ("i.weread.qq.com", "weread.qq.com")
+NOTION_HOST = "api.notion.com"
+
+# ==================== 模拟数据 ====================
+
+class Library:
+    """按书籍 ID 确定性生成的书库，划线和笔记按需生成，1 万本书、20 万条划线也只占很少内存
+
+    version 模拟微信读书的 synckey：每次 mutate 加一，增量接口只返回版本号更大的条目
+    """
+
+    def __init__(self, books=10, highlights=20, reviews=5, chapters=8, seed=1):
+        self.highlights = highlights
+        self.reviews = reviews
+        self.chapters = chapters
+        self.seed = seed
+        self.version = 1
+        self.rng = random.Random(seed)
+        self.books = {}
+        for i in range(books):
+            bookId = str(100000 + i)
+            rng = random.Random(f"{seed}:{bookId}")
+            days = [
+                {"readDate": BASE_TIME - BASE_TIME % 86400 + 86400 * d - 8 * 3600, "readTime": rng.randint(60, 3600)}
+                for d in range(rng.randint(1, 10))
+            ]
+            self.books[bookId] = {
+                "bookId": bookId,
+                "title": f"书{i}",
+                "author": f"作者{i % 97} 译者{i % 13}",
+                "intro": "简介",
+                "isbn": f"978{i:07d}",
+                "categories": [{"title": f"分类{i % 11}"}],
+                "newRating": 800,
+                "days": days,
+                "readingTime": sum(d["readTime"] for d in days),
+                "sort": BASE_TIME + i,
+                "lastReadingDate": BASE_TIME + 3600 * i,
+                "version": 1,
+                # 变更记录：新增的条目 [(version, item)]，删除的条目 {id: version}
+                "extra_marks": [],
+                "extra_reviews": [],
+                "removed": {},
+            }
+
+    def base_items(self, bookId, kind, count):
+        rng = random.Random(f"{self.seed}:{bookId}:{kind}")
+        items = []
+        for n in range(count):
+            start = rng.randint(0, 5000)
+            item = {
+                "bookId": bookId,
+                "chapterUid": rng.randint(1, self.chapters),
+                "range": f"{start}-{start + 20}",
+                "bookVersion": 1,
+                "createTime": BASE_TIME + rng.randint(0, 86400 * 700),
+            }
+            if kind == "mark":
+                item.update(bookmarkId=f"{bookId}_m{n}", markText=f"划线{n}", colorStyle=rng.randint(1, 5), style=0, type=1)
+            else:
+                item.update(reviewId=f"{bookId}_r{n}", content=f"想法{n}", abstract=f"原文{n}", type=1)
+            items.append((1, item))
+        return items
+
+    def get_items(self, bookId, kind, synckey=0):
+        book = self.books[bookId]
+        if kind == "mark":
+            items = self.base_items(bookId, kind, self.highlights) + book["extra_marks"]
+            key = "bookmarkId"
+        else:
+            items = self.base_items(bookId, kind, self.reviews) + book["extra_reviews"]
+            key = "reviewId"
+        updated = [item for version, item in items if version > synckey and item[key] not in book["removed"]]
+        removed = [id for id, version in book["removed"].items() if version > synckey and id.startswith(f"{bookId}_{kind[0]}")]
+        return updated, removed
+
+    def mutate(self, fraction):
+        """模拟两次同步之间的阅读：随机挑一部分书，加阅读时长、加一天阅读记录、加一条划线和笔记、删一条划线"""
+        self.version += 1
+        count = max(1, int(len(self.books) * fraction)) if fraction > 0 else 0
+        for bookId in self.rng.sample(sorted(self.books), min(count, len(self.books))):
+            book = self.books[bookId]
+            v = self.version
+            book["version"] = v
+            book["readingTime"] += 600
+            book["sort"] += 1
+            book["lastReadingDate"] += 86400
+            book["days"].append({"readDate": book["days"][-1]["readDate"] + 86400, "readTime": 600})
+            start = self.rng.randint(0, 5000)
+            common = {"bookId": bookId, "chapterUid": 1, "range": f"{start}-{start + 20}", "bookVersion": 1,
+                      "createTime": BASE_TIME + 86400 * 800 + v}
+            book["extra_marks"].append((v, dict(common, bookmarkId=f"{bookId}_m_v{v}", markText="新划线",
+                                                colorStyle=1, style=0, type=1)))
+            book["extra_reviews"].append((v, dict(common, reviewId=f"{bookId}_r_v{v}", content="新想法",
+                                                  abstract="新原文", type=1)))
+            book["removed"].setdefault(f"{bookId}_m0", v)
+        return count
+
+    def route(self, path, query, body):
+        if path == "/shelf/sync":
+            synckey = int(query.get("synckey") or 0)
+            changed = [b for b in self.books.values() if b["version"] > synckey]
+            return {
+                "synckey": self.version,
+                "books": [{"bookId": b["bookId"], "updateTime": b["lastReadingDate"]} for b in changed],
+                "bookProgress": [
+                    {"bookId": b["bookId"], "readingTime": b["readingTime"], "updateTime": b["lastReadingDate"]}
+                    for b in changed
+                ],
+                "archive": [],
+                "removed": [],
+            }
+        if path == "/user/notebooks":
+            return {"books": [{"bookId": b["bookId"], "book": {"title": b["title"]}, "sort": b["sort"]}
+                              for b in self.books.values()]}
+        if path == "/book/info":
+            book = self.books[query["bookId"]]
+            return {k: book[k] for k in ("bookId", "title", "author", "intro", "isbn", "categories", "newRating")}
+        if path == "/book/bookmarklist":
+            return {"updated": self.get_items(query["bookId"], "mark")[0]}
+        if path == "/book/readinfo":
+            book = self.books[query["bookId"]]
+            return {
+                "markedStatus": 2, "readingProgress": 50, "readingTime": book["readingTime"],
+                "totalReadDay": len(book["days"]), "readDetail": {"data": book["days"]},
+                "lastReadingDate": book["lastReadingDate"], "beginReadingDate": BASE_TIME,
+            }
+        if path == "/review/list":
+            updated, removed = self.get_items(query["bookId"], "review", int(query.get("syncKey") or 0))
+            return {"synckey": self.version, "reviews": [{"review": r} for r in updated], "removed": removed}
+        if path == "/book/chapterInfos":
+            bookId = body["bookIds"][0]
+            synckey = (body.get("synckeys") or [0])[0]
+            chapters = [
+                {"chapterUid": c, "chapterIdx": c, "updateTime": BASE_TIME, "readAhead": 0, "title": f"第{c}章", "level": 1}
+                for c in range(1, self.chapters + 1)
+            ] if not synckey else []
+            return {"data": [{"bookId": bookId, "synckey": 1, "updated": chapters, "removed": []}]}
+        return {}
+
+# ==================== 模拟服务 ====================
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # 默认不缓冲会把响应头和正文拆成两个包，触发 Nagle 延迟
+    wbufsize = 1 << 16
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, code, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_any(self, method):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        n = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(n)) if n else {}
+        self.send_json(*self.server.handle(method, url.path, query, body))
+
+    def do_GET(self):
+        self.handle_any("GET")
+
+    def do_POST(self):
+        self.handle_any("POST")
+
+    def do_PATCH(self):
+        self.handle_any("PATCH")
+
+    def do_DELETE(self):
+        self.handle_any("DELETE")
+
+
+class FakeServer(ThreadingHTTPServer):
+    """按接口计数，支持固定延迟和随机返回 429"""
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, rate_429=0.0, retry_after=0, seed=0):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.counts = Counter()
+        self.lock = threading.RLock()
+
+    def endpoint(self, method, path):
+        path = re.sub(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|[0-9a-f]{32}", "{id}", path)
+        return f"{method} {path}"
+
+    def handle(self, method, path, query, body):
+        with self.lock:
+            self.counts[self.endpoint(method, path)] += 1
+            throttled = self.rate_429 and self.rng.random() < self.rate_429
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            with self.lock:
+                self.counts["429"] += 1
+            error = {"object": "error", "status": 429, "code": "rate_limited", "message": "rate limited"}
+            return 429, error, {"Retry-After": str(self.retry_after)}
+        with self.lock:
+            try:
+                return self.route(method, path, query, body)
+            except KeyError as e:
+                return 404, {"object": "error", "status": 404, "code": "object_not_found", "message": str(e)}, None
+
+
+class FakeWeRead(FakeServer):
+    def __init__(self, library, **kwargs):
+        super().__init__(**kwargs)
+        self.library = library
+
+    def route(self, method, path, query, body):
+        return 200, self.library.route(path, query, body), None
+
+
+def to_property(value):
+    """把写入时的属性值转换成查询结果里的格式"""
+    for name in ("title", "rich_text"):
+        if name in value:
+            items = [dict(item, plain_text=item.get("text", {}).get("content", "")) for item in value[name]]
+            return {"type": name, name: items}
+    for name in ("number", "url", "select", "status", "date", "relation", "files", "checkbox", "multi_select"):
+        if name in value:
+            return {"type": name, name: value[name]}
+    return value
+
+
+def now_iso():
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+
+
+class FakeNotion(FakeServer):
+    """实现同步用到的 Notion 接口：数据库、页面、块的增删改查和 search"""
+
+    def __init__(self, root_id, **kwargs):
+        super().__init__(**kwargs)
+        self.databases = {}
+        self.pages = {root_id: {"object": "page", "id": root_id, "properties": {}, "parent": {"type": "workspace"}}}
+        self.rows = {}
+        self.blocks = {}
+        self.children = {root_id: []}
+
+    def match(self, page, filter):
+        if filter is None:
+            return True
+        if "and" in filter:
+            return all(self.match(page, f) for f in filter["and"])
+        if "or" in filter:
+            return any(self.match(page, f) for f in filter["or"])
+        if "timestamp" in filter:
+            condition = filter[filter["timestamp"]]
+            value = page[filter["timestamp"]]
+            if "on_or_after" in condition:
+                return value >= condition["on_or_after"]
+            if "after" in condition:
+                return value > condition["after"]
+            return True
+        prop = to_property(page["properties"].get(filter["property"]) or {})
+        if "title" in filter or "rich_text" in filter:
+            condition = filter.get("title") or filter.get("rich_text")
+            text = "".join(x.get("plain_text", "") for x in prop.get(prop.get("type"), []) or [])
+            return text == condition["equals"] if "equals" in condition else True
+        if "relation" in filter:
+            return filter["relation"]["contains"] in [x["id"] for x in prop.get("relation", [])]
+        if "number" in filter:
+            return prop.get("number") == filter["number"].get("equals")
+        return True
+
+    def page_out(self, page):
+        properties = {}
+        database = self.databases.get(page["parent"].get("database_id"))
+        for name, schema in (database or {}).get("properties", {}).items():
+            kind = next(iter(schema))
+            properties[name] = {"type": kind, kind: [] if kind in ("title", "rich_text", "files", "relation") else None}
+        properties.update({k: to_property(v) for k, v in page["properties"].items()})
+        return dict(page, properties=properties)
+
+    def block_out(self, block):
+        return dict(block, has_children=bool(self.children.get(block["id"])))
+
+    def add_block(self, parent_id, payload, parent_type):
+        block_id = str(uuid.uuid4())
+        block = {k: v for k, v in payload.items() if k != "children"}
+        kind = block.get("type")
+        inner = dict(block.get(kind, {}))
+        nested = inner.pop("children", None) or payload.get("children") or []
+        block[kind] = inner
+        block.update(object="block", id=block_id, parent={"type": parent_type, parent_type: parent_id}, archived=False)
+        self.blocks[block_id] = block
+        self.children[block_id] = [self.add_block(block_id, child, "block_id") for child in nested]
+        return block_id
+
+    def paginate(self, items, cursor, size):
+        start = int(cursor or 0)
+        size = int(size or 100)
+        more = start + size < len(items)
+        return {"object": "list", "results": items[start:start + size], "has_more": more,
+                "next_cursor": str(start + size) if more else None}
+
+    def route(self, method, path, query, body):
+        parts = path[len("/v1/"):].split("/")
+        if parts[0] == "search":
+            databases = [d for d in self.databases.values() if not d["archived"]]
+            return 200, self.paginate(databases, body.get("start_cursor"), body.get("page_size")), None
+        if parts[0] == "databases":
+            if len(parts) == 1:
+                database_id = str(uuid.uuid4())
+                title = body["title"][0]["text"]["content"]
+                parent = body["parent"]["page_id"]
+                self.databases[database_id] = {
+                    "object": "database", "id": database_id, "title": [{"plain_text": title}],
+                    "properties": body.get("properties", {}), "parent": body["parent"], "archived": False,
+                }
+                self.rows[database_id] = []
+                self.blocks[database_id] = {
+                    "object": "block", "id": database_id, "type": "child_database",
+                    "child_database": {"title": title}, "parent": {"type": "page_id", "page_id": parent},
+                }
+                self.children.setdefault(parent, []).append(database_id)
+                self.children[database_id] = []
+                return 200, self.databases[database_id], None
+            database = self.databases[parts[1]]
+            if len(parts) == 3:
+                rows = [self.pages[id] for id in self.rows[parts[1]]]
+                rows = [p for p in rows if not p["archived"] and self.match(p, body.get("filter"))]
+                response = self.paginate(rows, body.get("start_cursor"), body.get("page_size"))
+                response["results"] = [self.page_out(p) for p in response["results"]]
+                return 200, response, None
+            if method == "PATCH":
+                database["properties"].update(body.get("properties", {}))
+            return 200, database, None
+        if parts[0] == "pages":
+            if method == "POST":
+                page_id = str(uuid.uuid4())
+                page = {
+                    "object": "page", "id": page_id, "parent": body["parent"], "properties": body.get("properties", {}),
+                    "icon": body.get("icon"), "cover": body.get("cover"), "archived": False,
+                    "created_time": now_iso(), "last_edited_time": now_iso(),
+                }
+                database_id = body["parent"].get("database_id")
+                if database_id:
+                    schema = self.databases[database_id]["properties"]
+                    for name, value in page["properties"].items():
+                        schema.setdefault(name, {to_property(value)["type"]: {}})
+                    self.rows[database_id].append(page_id)
+                self.pages[page_id] = page
+                self.children[page_id] = []
+                return 200, self.page_out(page), None
+            page = self.pages[parts[1]]
+            if method == "PATCH":
+                page["properties"].update(body.get("properties", {}))
+                for key in ("icon", "cover"):
+                    if body.get(key) is not None:
+                        page[key] = body[key]
+                page["last_edited_time"] = now_iso()
+            return 200, self.page_out(page), None
+        if parts[0] == "blocks":
+            block_id = parts[1]
+            if len(parts) == 3:
+                if method == "GET":
+                    blocks = [self.blocks[id] for id in self.children[block_id] if not self.blocks[id].get("archived")]
+                    response = self.paginate(blocks, query.get("start_cursor"), query.get("page_size"))
+                    response["results"] = [self.block_out(b) for b in response["results"]]
+                    return 200, response, None
+                children = body.get("children", [])
+                if len(children) > 100:
+                    return 400, {"object": "error", "status": 400, "code": "validation_error", "message": "too many children"}, None
+                kids = self.children[block_id]
+                after = body.get("after")
+                if after and after not in kids:
+                    return 400, {"object": "error", "status": 400, "code": "validation_error", "message": "invalid after"}, None
+                parent_type = "page_id" if block_id in self.pages else "block_id"
+                ids = [self.add_block(block_id, child, parent_type) for child in children]
+                position = kids.index(after) + 1 if after else len(kids)
+                kids[position:position] = ids
+                return 200, {"object": "list", "results": [self.block_out(self.blocks[id]) for id in ids]}, None
+            if method == "DELETE":
+                target = self.pages.get(block_id) or self.blocks[block_id]
+                target["archived"] = True
+            if block_id in self.pages:
+                return 200, self.page_out(self.pages[block_id]), None
+            return 200, self.block_out(self.blocks[block_id]), None
+        return 400, {"object": "error", "status": 400, "code": "invalid_request_url", "message": path}, None
+
+
+def serve(args, conn):
+    """在子进程中运行两个模拟服务，这样主进程测到的内存只包含同步本身"""
+    library = Library(args.books, args.highlights, args.reviews, args.chapters, args.seed)
+    weread = FakeWeRead(library, latency=args.latency)
+    notion = FakeNotion(ROOT_PAGE_ID, latency=args.latency, rate_429=args.rate_429,
+                        retry_after=args.retry_after, seed=args.seed)
+    for server in (weread, notion):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    conn.send((weread.server_address[1], notion.server_address[1]))
+    while True:
+        command, value = conn.recv()
+        if command == "stats":
+            with weread.lock, notion.lock:
+                conn.send({"weread": dict(weread.counts), "notion": dict(notion.counts)})
+                weread.counts.clear()
+                notion.counts.clear()
+        elif command == "mutate":
+            with weread.lock:
+                conn.send(library.mutate(value))
+        elif command == "stop":
+            conn.send(None)
+            return
+
+# ==================== 运行基准 ====================
+
+def redirect(weread_port, notion_port):
+    """把发往微信读书和 Notion 的请求改写到本地模拟服务"""
+    def rewrite(url):
+        if url.host in WEREAD_HOSTS:
+            return url.copy_with(scheme="http", host="127.0.0.1", port=weread_port)
+        if url.host == NOTION_HOST:
+            return url.copy_with(scheme="http", host="127.0.0.1", port=notion_port)
+        return url
+
+    client_send = httpx.Client.send
+    async_client_send = httpx.AsyncClient.send
+
+    def send(self, request, *args, **kwargs):
+        request.url = rewrite(request.url)
+        return client_send(self, request, *args, **kwargs)
+
+    async def async_send(self, request, *args, **kwargs):
+        request.url = rewrite(request.url)
+        return await async_client_send(self, request, *args, **kwargs)
+
+    httpx.Client.send = send
+    httpx.AsyncClient.send = async_send
+
+
+def print_report(report):
+    print(f"--- 第{report['run']}次同步: {report['seconds']:.2f}s, 内存峰值 {report['peak_memory'] / 1024 / 1024:.1f}MB, "
+          f"微信读书 {sum(report['weread'].values())} 次, Notion {sum(report['notion'].values())} 次")
+    for service in ("weread", "notion"):
+        for endpoint, count in sorted(report[service].items()):
+            print(f"    {service:<7} {endpoint:<40} {count}")
+
+
+# 基线和本次运行的这些参数不同时，请求数没有可比性
+WORKLOAD_ARGS = ("books", "highlights", "reviews", "chapters", "runs", "mutate", "mode", "seed")
+
+
+def compare_reports(baseline, reports, tolerance):
+    """逐次同步对比请求数和内存峰值，返回超出基线 tolerance 比例的项；耗时受机器影响太大，不参与比较"""
+    regressions = []
+    for old, new in zip(baseline["runs"], reports):
+        items = [("peak_memory", old["peak_memory"], new["peak_memory"])]
+        for service in ("weread", "notion"):
+            items.append((f"{service} 总计", sum(old[service].values()), sum(new[service].values())))
+            for endpoint in sorted(set(old[service]) | set(new[service])):
+                items.append((f"{service} {endpoint}", old[service].get(endpoint, 0), new[service].get(endpoint, 0)))
+        for name, before, after in items:
+            if after > before * (1 + tolerance):
+                regressions.append(f"第{new['run']}次同步 {name}: {before} → {after}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线运行 WeReadSync 并统计请求数、耗时和内存")
+    parser.add_argument("--books", type=int, default=10)
+    parser.add_argument("--highlights", type=int, default=20, help="每本书的划线数")
+    parser.add_argument("--reviews", type=int, default=5, help="每本书的笔记数")
+    parser.add_argument("--chapters", type=int, default=8)
+    parser.add_argument("--runs", type=int, default=2, help="连续同步次数，第一次为全量，之后为增量")
+    parser.add_argument("--mutate", type=float, default=0.1, help="两次同步之间有新阅读的书所占比例")
+    parser.add_argument("--mode", default="all", choices=("all", "books", "notes"))
+    parser.add_argument("--latency", type=float, default=0.0, help="模拟服务每个请求的延迟（秒）")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Notion 请求返回 429 的概率")
+    parser.add_argument("--retry-after", type=int, default=0)
+    parser.add_argument("--notion-rate", type=float, default=1000, help="Notion 令牌桶速率，默认不限速")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--engine", default="thread", choices=("thread", "async"))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-tracemalloc", action="store_true",
+                        help="不用 tracemalloc（它会让同步变慢数倍），内存峰值改为进程的最大常驻内存")
+    parser.add_argument("--json", help="把结果写入 JSON 文件")
+    parser.add_argument("--baseline", help="和之前用 --json 保存的结果对比，请求数或内存峰值超出基线时退出码为 1")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="和基线对比时允许超出的比例")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        different = [k for k in WORKLOAD_ARGS if baseline["args"].get(k) != getattr(args, k)]
+        if different:
+            parser.error(f"基线的参数 {', '.join(different)} 和本次不同，结果无法对比")
+
+    conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(args, child_conn), daemon=True)
+    server.start()
+    weread_port, notion_port = conn.recv()
+    redirect(weread_port, notion_port)
+
+    state_dir = tempfile.mkdtemp(prefix="weread2notion-bench-")
+    os.environ.update(
+        NOTION_TOKEN="benchmark",
+        NOTION_PAGE=f"https://www.notion.so/benchmark-{ROOT_PAGE_ID}",
+        WEREAD_COOKIE="wr_vid=1; wr_skey=benchmark",
+        STATE_PATH=os.path.join(state_dir, "state.db"),
+        METRICS_PATH=os.path.join(state_dir, "metrics.json"),
+        NOTION_RATE_LIMIT=str(args.notion_rate),
+        SYNC_WORKERS=str(args.workers),
+        SYNC_ENGINE=args.engine,
+    )
+    for key in ("CC_ID", "CC_PASSWORD"):
+        os.environ.pop(key, None)
+    from weread2notion import WeReadSync
+
+    reports = []
+    for run in range(1, args.runs + 1):
+        if run > 1:
+            conn.send(("mutate", args.mutate))
+            conn.recv()
+        conn.send(("stats", None))
+        conn.recv()
+        if not args.no_tracemalloc:
+            tracemalloc.start()
+        start = time.perf_counter()
+        WeReadSync().run(args.mode)
+        seconds = time.perf_counter() - start
+        if args.no_tracemalloc:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        else:
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        conn.send(("stats", None))
+        report = dict(run=run, seconds=seconds, peak_memory=peak, **conn.recv())
+        reports.append(report)
+        print_report(report)
+
+    conn.send(("stop", None))
+    conn.recv()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "runs": reports}, f, ensure_ascii=False, indent=2)
+    if baseline:
+        regressions = compare_reports(baseline, reports, args.tolerance)
+        for line in regressions:
+            print(f"回归: {line}")
+        if regressions:
+            raise SystemExit(1)
+        print(f"和基线 {args.baseline} 相比没有超出 {args.tolerance:.0%} 的项")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,15 +10,29 @@ import json
 import hashlib
 import time
 import logging
+import asyncio
+import argparse
 import calendar
-import requests
+import contextlib
+import contextvars
+import cProfile
+import functools
+import pstats
+import random
+import signal
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from requests.utils import cookiejar_from_dict
+from operator import attrgetter
 from dotenv import load_dotenv
 
+import httpx
 import pendulum
-from retrying import retry
-from notion_client import Client
+from notion_client import AsyncClient, Client
+from notion_client.api_endpoints import Endpoint
+from notion_client.errors import HTTPResponseError, RequestTimeoutError
 
 # 加载环境变量
 load_dotenv()
@@ -69,12 +83,65 @@ BOOKMARK_ICON_URL = "https://www.notion.so/icons/bookmark_gray.svg"
 BOOK_ICON_URL = "https://www.notion.so/icons/book_gray.svg"
 
 WEREAD_URL = "https://weread.qq.com/"
+WEREAD_SHELF_URL = "https://i.weread.qq.com/shelf/sync"
 WEREAD_NOTEBOOKS_URL = "https://i.weread.qq.com/user/notebooks"
 WEREAD_BOOKMARKLIST_URL = "https://i.weread.qq.com/book/bookmarklist"
 WEREAD_CHAPTER_INFO = "https://i.weread.qq.com/book/chapterInfos"
 WEREAD_READ_INFO_URL = "https://i.weread.qq.com/book/readinfo"
 WEREAD_REVIEW_LIST_URL = "https://i.weread.qq.com/review/list"
 WEREAD_BOOK_INFO = "https://i.weread.qq.com/book/info"
+WEREAD_READ_INFO_PARAMS = dict(
+    noteCount=1, readingDetail=1, finishedBookIndex=1,
+    readingBookCount=1, readingBookIndex=1, finishedBookCount=1,
+    finishedDate=1,
+)
+WEREAD_READ_INFO_HEADERS = {
+    "baseapi": "32",
+    "appver": "8.2.5.10163885",
+    "basever": "8.2.5.10163885",
+    "osver": "12",
+    "User-Agent": "WeRead/8.2.5 WRBrand/xiaomi Dalvik/2.1.0 (Linux; U; Android 12; Redmi Note 7 Pro Build/SQ3A.220705.004)",
+}
+
+# Notion 平均限速约 3 次/秒
+NOTION_RATE_LIMIT = 3
+NOTION_MAX_RETRIES = 6
+# 409 conflict_error 为并发写入冲突，Notion 文档说明可以重试
+NOTION_RETRY_STATUSES = (409,)
+NOTION_BACKOFF_BASE = 0.5
+NOTION_BACKOFF_MAX = 30
+# 追加子块时每个 children 数组最多 100 个块，整个请求最多 1000 个块
+NOTION_MAX_CHILDREN = 100
+NOTION_MAX_BLOCKS = 1000
+
+# 本地状态库，保存 Notion ID 映射，超过 STATE_FULL_SYNC_DAYS 天做一次全量对账
+STATE_PATH = ".weread2notion/state.db"
+STATE_FULL_SYNC_DAYS = 7
+# 同步书籍时每完成 CHECKPOINT_BOOKS 本写出一次缓冲并记进检查点，中断后从检查点继续
+CHECKPOINT_BOOKS = 20
+# 设置 --time-budget 时留出预算的这一部分写出缓冲，其余用完后不再开始新的书
+TIME_BUDGET_RESERVE = 0.1
+# 异步引擎每批预取的书数，处理完一批、时间预算还有剩余才预取下一批
+PREFETCH_BOOKS = 20
+
+# 书籍信息和章节列表的本地缓存天数，书籍 updateTime 变化时提前失效；WEREAD_REFRESH=1 时忽略缓存
+WEREAD_CACHE_DAYS = 7
+
+# 每个微信读书账号同时进行的请求数；NOTION_CONCURRENCY 为 SYNC_ENGINE=async 时同时进行的 Notion 请求数
+WEREAD_CONCURRENCY = 4
+NOTION_CONCURRENCY = 8
+WEREAD_MAX_RETRIES = 3
+WEREAD_RETRY_WAIT = 5
+# 微信读书请求的超时秒数（连接, 读取）
+WEREAD_TIMEOUT = (10, 30)
+
+# 运行结束时写出请求统计；PROMETHEUS_TEXTFILE 非空时另外写一份 Prometheus 文本格式
+METRICS_PATH = ".weread2notion/metrics.json"
+METRICS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# 多账号同步时同时进行的账号数；ACCOUNT_KEYS 为各账号在配置文件里单独填写、不从环境变量继承的配置
+ACCOUNT_CONCURRENCY = 2
+ACCOUNT_KEYS = ("WEREAD_COOKIE", "CC_URL", "CC_ID", "CC_PASSWORD", "NOTION_TOKEN", "NOTION_PAGE")
 
 rating = {"poor": "⭐️", "fair": "⭐️⭐️⭐️", "good": "⭐️⭐️⭐️⭐️⭐️"}
 
@@ -144,6 +211,12 @@ def get_quote(content):
         },
     }
 
+def count_blocks(block):
+    """块本身加上嵌套子块的总数"""
+    children = block.get(block.get("type"), {}).get("children", [])
+    return 1 + sum(map(count_blocks, children))
+
+
 def get_block(content, block_type, show_color, style, colorStyle, reviewId):
     color = "default"
     if show_color:
@@ -221,7 +294,7 @@ def get_properties(dict1, dict2):
         elif prop_type == RICH_TEXT:
             property_val = {"rich_text": [{"type": "text", "text": {"content": str(value)[:MAX_LENGTH]}}]}
         elif prop_type == NUMBER:
-            property_val = {"number": number}
+            property_val = {"number": value}
         elif prop_type == STATUS:
             property_val = {"status": {"name": value}}
         elif prop_type == FILES:
@@ -268,19 +341,321 @@ def str_to_timestamp(date_str):
     dt = pendulum.parse(date_str)
     return int(dt.timestamp())
 
-def get_rich_text_from_result(result, name):
-    return result.get("properties").get(name).get("rich_text")[0].get("plain_text")
+def get_property_hash(value):
+    return hashlib.md5(json.dumps(value, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
 
-def get_number_from_result(result, name):
-    return result.get("properties").get(name).get("number")
 
-# ==================== 微信读书 API ====================
+def parse_shard(value):
+    """把 "i/N" 解析成 (i, N)，没有分片或 N 为 1 时返回 None"""
+    if not value:
+        return None
+    index, count = (int(x) for x in value.split("/"))
+    if not 0 <= index < count:
+        raise ValueError(f"分片 {value} 无效，应为 i/N 且 0 <= i < N")
+    return (index, count) if count > 1 else None
+
+def in_shard(bookId, shard):
+    """按 bookId 的 md5 分片，不受进程的哈希随机化影响，各分片结果一致"""
+    return shard is None or int(hashlib.md5(bookId.encode()).hexdigest(), 16) % shard[1] == shard[0]
+
+
+def merge_by_key(items, updates, key, removed=()):
+    """按 key 把增量 updates 合并进 items，并去掉 removed 中的条目"""
+    merged = {x.get(key): x for x in items}
+    merged.update({x.get(key): x for x in updates})
+    for k in removed:
+        merged.pop(k, None)
+    return list(merged.values())
+
+def map_in_pool(func, items, workers=1):
+    """并发执行 func，按 items 的顺序产出结果；任一任务失败时取消尚未开始的任务"""
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        futures = [executor.submit(func, item) for item in items]
+        for future in futures:
+            yield future.result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+class LoopThread:
+    """在后台线程里运行的事件循环，第一次调用 run 时启动；run 可在其他任意线程调用并等待协程结果"""
 
-class WeReadApi:
     def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def run(self, coro):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+                self.thread.start()
+        if threading.current_thread() is self.thread:
+            coro.close()
+            raise RuntimeError("不能在事件循环线程里同步等待协程")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def close(self):
+        with self.lock:
+            if self.loop is None:
+                return
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = self.thread = None
+
+# ==================== 运行指标 ====================
+
+# 当前线程或协程最近一次请求的 (Metrics, 接口)，重试时据此记到刚失败的接口上
+LAST_REQUEST = contextvars.ContextVar("last_request", default=None)
+
+
+class Metrics:
+    """按接口统计请求次数、状态码、耗时分布、响应字节数和重试次数，线程安全"""
+
+    def __init__(self, trace=False):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.origin = time.perf_counter()
+        self.endpoints = {}
+        self.counters = {}
+        # 开启追踪时记录 Chrome trace 事件
+        self.events = [] if trace else None
+        self.threads = {}
+        # 数据库 ID → 名称，统计时用名称代替 ID，方便看出是哪个数据库的查询
+        self.names = {}
+
+    def endpoint(self, service, method, url):
+        path = httpx.URL(str(url)).path
+        path = re.sub(
+            r"[0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}",
+            lambda m: "{" + self.names.get(m.group(0).replace("-", ""), "id") + "}",
+            path,
+        )
+        return f"{service} {method} {path}"
+
+    def record(self, endpoint, status, seconds, size):
+        LAST_REQUEST.set((self, endpoint))
+        with self.lock:
+            stat = self.endpoints.setdefault(endpoint, {
+                "count": 0, "seconds": 0.0, "bytes": 0, "retries": 0, "status": {},
+                "buckets": [0] * (len(METRICS_BUCKETS) + 1),
+            })
+            stat["count"] += 1
+            stat["seconds"] += seconds
+            stat["bytes"] += size
+            stat["status"][str(status)] = stat["status"].get(str(status), 0) + 1
+            stat["buckets"][sum(1 for b in METRICS_BUCKETS if seconds > b)] += 1
+        if self.events is not None:
+            self.add_event(endpoint, "http", time.perf_counter() - seconds, seconds, status)
+
+    def retry(self, endpoint):
+        with self.lock:
+            if endpoint in self.endpoints:
+                self.endpoints[endpoint]["retries"] += 1
+
+    def span(self, name, detail=None):
+        """记录一段嵌套的耗时区间，未开启追踪时什么都不做"""
+        if self.events is None:
+            return contextlib.nullcontext()
+        return self.trace_span(name, detail)
+
+    @contextlib.contextmanager
+    def trace_span(self, name, detail):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_event(name, "phase", start, time.perf_counter() - start, detail)
+
+    def add_event(self, name, category, start, seconds, detail=None):
+        thread = threading.current_thread()
+        event = {
+            "name": name, "cat": category, "ph": "X", "pid": os.getpid(), "tid": thread.ident,
+            "ts": round((start - self.origin) * 1e6), "dur": round(seconds * 1e6),
+        }
+        if detail is not None:
+            event["args"] = {"detail": detail}
+        with self.lock:
+            self.events.append(event)
+            self.threads[thread.ident] = thread.name
+
+    def write_trace(self, path):
+        """写出 Chrome trace-event 格式的 JSON，可在 chrome://tracing 或 Perfetto 中打开"""
+        with self.lock:
+            events = [
+                {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}}
+                for tid, name in self.threads.items()
+            ] + list(self.events)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        with self.lock:
+            endpoints = {}
+            for endpoint, stat in sorted(self.endpoints.items()):
+                cumulative = 0
+                histogram = {}
+                for bound, count in zip(METRICS_BUCKETS + ("+Inf",), stat["buckets"]):
+                    cumulative += count
+                    histogram[str(bound)] = cumulative
+                endpoints[endpoint] = dict(
+                    {k: v for k, v in stat.items() if k != "buckets"}, seconds=round(stat["seconds"], 3), histogram=histogram
+                )
+            return {
+                "started": pendulum.from_timestamp(self.started).to_iso8601_string(),
+                "seconds": round(time.time() - self.started, 3),
+                "requests": sum(x["count"] for x in endpoints.values()),
+                "counters": dict(self.counters),
+                "endpoints": endpoints,
+            }
+
+    def prometheus(self, report):
+        lines = [
+            "# TYPE weread2notion_run_seconds gauge",
+            f"weread2notion_run_seconds {report['seconds']}",
+            "# TYPE weread2notion_run_timestamp_seconds gauge",
+            f"weread2notion_run_timestamp_seconds {self.started:.0f}",
+        ]
+        if report["counters"]:
+            lines.append("# TYPE weread2notion_items gauge")
+        for name, value in report["counters"].items():
+            lines.append(f'weread2notion_items{{name="{name}"}} {value}')
+        for name, kind in (("requests_total", "counter"), ("request_duration_seconds", "histogram"),
+                           ("response_bytes_total", "counter"), ("retries_total", "counter")):
+            lines.append(f"# TYPE weread2notion_{name} {kind}")
+            for endpoint, stat in report["endpoints"].items():
+                service, method, path = endpoint.split(" ", 2)
+                labels = f'service="{service}",method="{method}",path="{path}"'
+                if name == "requests_total":
+                    lines += [f'weread2notion_{name}{{{labels},status="{status}"}} {count}' for status, count in stat["status"].items()]
+                elif name == "request_duration_seconds":
+                    lines += [f'weread2notion_{name}_bucket{{{labels},le="{le}"}} {count}' for le, count in stat["histogram"].items()]
+                    lines += [f"weread2notion_{name}_sum{{{labels}}} {stat['seconds']}", f"weread2notion_{name}_count{{{labels}}} {stat['count']}"]
+                elif name == "response_bytes_total":
+                    lines.append(f"weread2notion_{name}{{{labels}}} {stat['bytes']}")
+                else:
+                    lines.append(f"weread2notion_{name}{{{labels}}} {stat['retries']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, textfile=None):
+        """写出 JSON 报告；textfile 为 Prometheus node_exporter 文本采集目录下的文件，先写临时文件再替换"""
+        report = self.report()
+        outputs = [(path, json.dumps(report, ensure_ascii=False, indent=2))]
+        if textfile:
+            outputs.append((textfile, self.prometheus(report)))
+        for target, content in outputs:
+            if os.path.dirname(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(f"{target}.tmp", "w") as f:
+                f.write(content)
+            os.replace(f"{target}.tmp", target)
+        return report
+
+
+def traced(func):
+    """把方法的执行记为追踪区间，第一个参数是字符串时（通常是 bookId）一并记下"""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        detail = args[0] if args and isinstance(args[0], str) else None
+        with self.metrics.span(func.__name__, detail):
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+def record_retry():
+    last = LAST_REQUEST.get()
+    if last:
+        metrics, endpoint = last
+        metrics.retry(endpoint)
+
+
+def weread_retry(func):
+    """失败后等待 WEREAD_RETRY_WAIT 秒重试，最多尝试 WEREAD_MAX_RETRIES 次，并把重试记到刚失败的接口上"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        for attempt in range(1, WEREAD_MAX_RETRIES + 1):
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                if attempt == WEREAD_MAX_RETRIES:
+                    raise
+                record_retry()
+                await asyncio.sleep(WEREAD_RETRY_WAIT)
+    return wrapper
+
+
+# ==================== 微信读书 API ====================
+
+class AsyncWeReadApi:
+    """微信读书接口的唯一实现：请求、解析、缓存和 synckey 合并都在这里，请求用 httpx.AsyncClient 在事件循环里发送
+
+    同一账号的请求共用一个 WEREAD_CONCURRENCY 并发上限；同步调用由 WeReadApi 包装，异步引擎直接并发调用这里的协程
+    """
+
+    def __init__(self, state=None, metrics=None, config=None):
+        # config 为账号配置，缺省时读环境变量
+        self.config = os.environ if config is None else config
         self.cookie = self.get_cookie()
-        self.session = requests.Session()
-        self.session.cookies = self.parse_cookie_string()
+        self.cookies = self.parse_cookie_string()
+        self.metrics = metrics or Metrics()
+        # 连接池、并发上限和锁绑定到事件循环，第一次请求时在事件循环里创建
+        self.session = None
+        # 首页只在第一次请求前访问一次，Cookie 过期后再重新访问
+        self.warmed = False
+        # 有本地状态库时按账号保存 synckey，下次只拉增量
+        self.state = state
+        self.account = self.cookies.get("wr_vid") or hashlib.md5(self.cookie.encode()).hexdigest()
+        # 书架和笔记本列表里各书的 updateTime，用来判断书籍信息和章节缓存是否失效
+        self.versions = {}
+        self.refresh = self.config.get("WEREAD_REFRESH") == "1"
+        self.cache_days = float(self.config.get("WEREAD_CACHE_DAYS", WEREAD_CACHE_DAYS))
+
+    def open(self):
+        limit = int(self.config.get("WEREAD_CONCURRENCY", WEREAD_CONCURRENCY))
+        connect, read = WEREAD_TIMEOUT
+        self.limit = asyncio.Semaphore(limit)
+        self.warm_lock = asyncio.Lock()
+        self.session = httpx.AsyncClient(
+            cookies=self.cookies,
+            timeout=httpx.Timeout(read, connect=connect),
+            limits=httpx.Limits(max_connections=limit),
+            event_hooks={"response": [self.record_response]},
+        )
+
+    async def aclose(self):
+        if self.session is not None:
+            # 首页刷新过的 Cookie 留给下次打开的连接池
+            self.cookies = self.session.cookies
+            await self.session.aclose()
+            self.session = None
+
+    async def request(self, method, url, **kwargs):
+        if self.session is None:
+            self.open()
+        async with self.limit:
+            await self.warm_up()
+            return await self.session.request(method, url, **kwargs)
+
+    async def warm_up(self):
+        """访问微信读书首页刷新 Cookie，各请求共用，一次运行只访问一次"""
+        async with self.warm_lock:
+            if not self.warmed:
+                await self.session.get(WEREAD_URL)
+                self.warmed = True
+
+    async def record_response(self, response):
+        await response.aread()
+        endpoint = self.metrics.endpoint("weread", response.request.method, response.request.url)
+        self.metrics.record(endpoint, response.status_code, response.elapsed.total_seconds(), len(response.content))
 
     def try_get_cloud_cookie(self, url, id, password):
         if url.endswith("/"):
@@ -288,7 +663,7 @@ class WeReadApi:
         req_url = f"{url}/get/{id}"
         data = {"password": password}
         result = None
-        response = requests.post(req_url, data=data)
+        response = httpx.post(req_url, data=data)
         if response.status_code == 200:
             data = response.json()
             cookie_data = data.get("cookie_data")
@@ -299,12 +674,12 @@ class WeReadApi:
         return result
 
     def get_cookie(self):
-        url = os.getenv("CC_URL")
+        url = self.config.get("CC_URL")
         if not url:
             url = "https://cookiecloud.malinkang.com/"
-        cc_id = os.getenv("CC_ID")
-        password = os.getenv("CC_PASSWORD")
-        cookie = os.getenv("WEREAD_COOKIE")
+        cc_id = self.config.get("CC_ID")
+        password = self.config.get("CC_PASSWORD")
+        cookie = self.config.get("WEREAD_COOKIE")
         if url and cc_id and password:
             cookie = self.try_get_cloud_cookie(url, cc_id, password)
         if not cookie or not cookie.strip():
@@ -317,55 +692,121 @@ class WeReadApi:
         matches = pattern.findall(self.cookie)
         for key, value in matches:
             cookies_dict[key] = value.encode('unicode_escape').decode('ascii')
-        return cookiejar_from_dict(cookies_dict)
+        return cookies_dict
 
     def handle_errcode(self, errcode):
         if errcode in (-2012, -2010):
             print(f"::error::微信读书Cookie过期了，请参考文档重新设置。")
+            # 下次请求（包括重试）前重新访问首页
+            self.warmed = False
+
+    def load_sync(self, scope):
+        if self.state is None:
+            return 0, None
+        return self.state.get_sync(self.account, scope)
+
+    def save_sync(self, scope, synckey, data):
+        if self.state is not None and synckey:
+            self.state.save_sync(self.account, scope, synckey, data)
+
+    def remember_versions(self, books):
+        for book in books:
+            if book.get("updateTime"):
+                self.versions[book.get("bookId")] = book.get("updateTime")
+
+    def load_cache(self, kind, bookId):
+        """返回缓存的书籍信息或章节；强制刷新、超过缓存天数或书籍 updateTime 变了时返回 None"""
+        if self.state is None or self.refresh:
+            return None
+        row = self.state.get_cache(f"{kind}:{bookId}")
+        if row is None:
+            return None
+        version, fetched_at, data = row
+        if time.time() - fetched_at > self.cache_days * 86400:
+            return None
+        if bookId in self.versions and str(self.versions.get(bookId)) != version:
+            return None
+        self.metrics.add(f"{kind}_cache_hits")
+        return data
+
+    def save_cache(self, kind, bookId, data):
+        if self.state is not None and data:
+            self.state.save_cache(f"{kind}:{bookId}", str(self.versions.get(bookId)), data)
+
+    def check_delta(self, data, synckey):
+        """增量请求被拒绝时返回 None，调用方回退到 synckey=0 的全量请求"""
+        if not synckey or (not data.get("errcode") and "synckey" in data):
+            return data
+        print(f"synckey {synckey} 已失效，改为全量同步")
+        return None
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
-    def get_bookshelf(self):
-        self.session.get(WEREAD_URL)
-        r = self.session.get("https://i.weread.qq.com/shelf/sync?synckey=0&teenmode=0&album=1&onlyBookid=0")
-        if r.ok:
-            return r.json()
+    @weread_retry
+    async def get_bookshelf(self):
+        synckey, shelf = self.load_sync("shelf")
+        data = await self.request_bookshelf(synckey) if shelf else None
+        if data is None:
+            shelf = None
+            data = await self.request_bookshelf(0)
+        if shelf:
+            shelf.update({k: v for k, v in data.items() if k not in ("books", "bookProgress", "removed")})
+            removed = data.get("removed", [])
+            shelf["books"] = merge_by_key(shelf.get("books", []), data.get("books", []), "bookId", removed)
+            shelf["bookProgress"] = merge_by_key(
+                shelf.get("bookProgress", []), data.get("bookProgress", []), "bookId", removed
+            )
+        else:
+            shelf = data
+        self.save_sync("shelf", data.get("synckey"), shelf)
+        self.remember_versions(shelf.get("books", []))
+        return shelf
+
+    async def request_bookshelf(self, synckey):
+        params = dict(synckey=synckey, teenmode=0, album=1, onlyBookid=0)
+        r = await self.request("GET", WEREAD_SHELF_URL, params=params)
+        if r.is_success:
+            return self.check_delta(r.json(), synckey)
         else:
             errcode = r.json().get("errcode", 0)
             self.handle_errcode(errcode)
+            if synckey:
+                return None
             raise Exception(f"Could not get bookshelf {r.text}")
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
-    def get_notebooklist(self):
-        self.session.get(WEREAD_URL)
-        r = self.session.get(WEREAD_NOTEBOOKS_URL)
-        if r.ok:
+    @weread_retry
+    async def get_notebooklist(self):
+        r = await self.request("GET", WEREAD_NOTEBOOKS_URL)
+        if r.is_success:
             data = r.json()
             books = data.get("books")
             books.sort(key=lambda x: x["sort"])
+            self.remember_versions([dict(x.get("book") or {}, bookId=x.get("bookId")) for x in books])
             return books
         else:
             errcode = r.json().get("errcode", 0)
             self.handle_errcode(errcode)
             raise Exception(f"Could not get notebook list {r.text}")
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
-    def get_bookinfo(self, bookId):
-        self.session.get(WEREAD_URL)
+    @weread_retry
+    async def get_bookinfo(self, bookId):
+        bookInfo = self.load_cache("bookinfo", bookId)
+        if bookInfo is not None:
+            return bookInfo
         params = dict(bookId=bookId)
-        r = self.session.get(WEREAD_BOOK_INFO, params=params)
-        if r.ok:
-            return r.json()
+        r = await self.request("GET", WEREAD_BOOK_INFO, params=params)
+        if r.is_success:
+            bookInfo = r.json()
+            self.save_cache("bookinfo", bookId, bookInfo)
+            return bookInfo
         else:
             errcode = r.json().get("errcode", 0)
             self.handle_errcode(errcode)
             print(f"Could not get book info {r.text}")
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
-    def get_bookmark_list(self, bookId):
-        self.session.get(WEREAD_URL)
+    @weread_retry
+    async def get_bookmark_list(self, bookId):
         params = dict(bookId=bookId)
-        r = self.session.get(WEREAD_BOOKMARKLIST_URL, params=params)
-        if r.ok:
+        r = await self.request("GET", WEREAD_BOOKMARKLIST_URL, params=params)
+        if r.is_success:
             bookmarks = r.json().get("updated")
             return bookmarks
         else:
@@ -373,63 +814,89 @@ class WeReadApi:
             self.handle_errcode(errcode)
             raise Exception(f"Could not get {bookId} bookmark list")
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
-    def get_read_info(self, bookId):
-        self.session.get(WEREAD_URL)
-        params = dict(
-            noteCount=1, readingDetail=1, finishedBookIndex=1,
-            readingBookCount=1, readingBookIndex=1, finishedBookCount=1,
-            bookId=bookId, finishedDate=1,
-        )
-        headers = {
-            "baseapi": "32",
-            "appver": "8.2.5.10163885",
-            "basever": "8.2.5.10163885",
-            "osver": "12",
-            "User-Agent": "WeRead/8.2.5 WRBrand/xiaomi Dalvik/2.1.0 (Linux; U; Android 12; Redmi Note 7 Pro Build/SQ3A.220705.004)",
-        }
-        r = self.session.get(WEREAD_READ_INFO_URL, headers=headers, params=params)
-        if r.ok:
+    @weread_retry
+    async def get_read_info(self, bookId):
+        params = dict(WEREAD_READ_INFO_PARAMS, bookId=bookId)
+        r = await self.request("GET", WEREAD_READ_INFO_URL, headers=WEREAD_READ_INFO_HEADERS, params=params)
+        if r.is_success:
             return r.json()
         else:
             errcode = r.json().get("errcode", 0)
             self.handle_errcode(errcode)
             raise Exception(f"get {bookId} read info failed {r.text}")
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
-    def get_review_list(self, bookId):
-        self.session.get(WEREAD_URL)
-        params = dict(bookId=bookId, listType=11, mine=1, syncKey=0)
-        r = self.session.get(WEREAD_REVIEW_LIST_URL, params=params)
-        if r.ok:
-            reviews = r.json().get("reviews")
-            reviews = list(map(lambda x: x.get("review"), reviews))
-            reviews = [{"chapterUid": 1000000, **x} if x.get("type") == 4 else x for x in reviews]
-            return reviews
+    @weread_retry
+    async def get_review_list(self, bookId):
+        scope = f"review:{bookId}"
+        synckey, reviews = self.load_sync(scope)
+        data = await self.request_review_list(bookId, synckey) if reviews is not None else None
+        if data is None:
+            reviews = []
+            data = await self.request_review_list(bookId, 0)
+        return self.merge_review_list(bookId, reviews, data)
+
+    def merge_review_list(self, bookId, reviews, data):
+        updated = list(map(lambda x: x.get("review"), data.get("reviews") or []))
+        reviews = merge_by_key(reviews, updated, "reviewId", data.get("removed", []))
+        self.save_sync(f"review:{bookId}", data.get("synckey"), reviews)
+        return [{"chapterUid": 1000000, **x} if x.get("type") == 4 else x for x in reviews]
+
+    async def request_review_list(self, bookId, synckey):
+        params = dict(bookId=bookId, listType=11, mine=1, syncKey=synckey)
+        r = await self.request("GET", WEREAD_REVIEW_LIST_URL, params=params)
+        if r.is_success:
+            return self.check_delta(r.json(), synckey)
         else:
             errcode = r.json().get("errcode", 0)
             self.handle_errcode(errcode)
+            if synckey:
+                return None
             raise Exception(f"get {bookId} review list failed {r.text}")
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
-    def get_chapter_info(self, bookId):
-        self.session.get(WEREAD_URL)
-        body = {"bookIds": [bookId], "synckeys": [0], "teenmode": 0}
-        r = self.session.post(WEREAD_CHAPTER_INFO, json=body)
-        if (r.ok and "data" in r.json() and len(r.json()["data"]) == 1 
-            and "updated" in r.json()["data"][0]):
-            update = r.json()["data"][0]["updated"]
-            update.append({
-                "chapterUid": 1000000,
-                "chapterIdx": 1000000,
-                "updateTime": 1683825006,
-                "readAhead": 0,
-                "title": "点评",
-                "level": 1,
-            })
-            return {item["chapterUid"]: item for item in update}
+    @weread_retry
+    async def get_chapter_info(self, bookId):
+        cached = self.load_cache("chapter", bookId)
+        if cached is not None:
+            return self.chapter_dict(cached)
+        scope = f"chapter:{bookId}"
+        synckey, chapters = self.load_sync(scope)
+        data = await self.request_chapter_info(bookId, synckey) if chapters is not None else None
+        if data is None:
+            chapters = []
+            data = await self.request_chapter_info(bookId, 0)
+        return self.merge_chapter_info(bookId, chapters, data)
+
+    def merge_chapter_info(self, bookId, chapters, data):
+        update = merge_by_key(chapters, data.get("updated", []), "chapterUid", data.get("removed", []))
+        self.save_sync(f"chapter:{bookId}", data.get("synckey"), update)
+        self.save_cache("chapter", bookId, update)
+        return self.chapter_dict(update)
+
+    def chapter_dict(self, chapters):
+        update = chapters + [{
+            "chapterUid": 1000000,
+            "chapterIdx": 1000000,
+            "updateTime": 1683825006,
+            "readAhead": 0,
+            "title": "点评",
+            "level": 1,
+        }]
+        return {item["chapterUid"]: item for item in update}
+
+    async def request_chapter_info(self, bookId, synckey):
+        body = {"bookIds": [bookId], "synckeys": [synckey], "teenmode": 0}
+        r = await self.request("POST", WEREAD_CHAPTER_INFO, json=body)
+        return self.check_chapter_info(bookId, synckey, r.json() if r.is_success else {}, r.text)
+
+    def check_chapter_info(self, bookId, synckey, payload, text):
+        data = payload.get("data") or []
+        if len(data) == 1 and "updated" in data[0]:
+            return self.check_delta(data[0], synckey)
+        elif synckey:
+            print(f"synckey {synckey} 已失效，改为全量同步")
+            return None
         else:
-            raise Exception(f"get {bookId} chapter info failed {r.text}")
+            raise Exception(f"get {bookId} chapter info failed {text}")
 
     def transform_id(self, book_id):
         id_length = len(book_id)
@@ -467,8 +934,481 @@ class WeReadApi:
     def get_url(self, book_id):
         return f"https://weread.qq.com/web/reader/{self.calculate_book_str_id(book_id)}"
 
+
+class WeReadApi:
+    """AsyncWeReadApi 的同步包装：在后台事件循环里执行对应的协程并等待结果，可在多个线程里同时调用"""
+
+    def __init__(self, state=None, metrics=None, config=None):
+        self.client = AsyncWeReadApi(state, metrics, config)
+        self.metrics = self.client.metrics
+        self.loop = LoopThread()
+
+    def run(self, coro):
+        return self.loop.run(coro)
+
+    def close(self):
+        """关闭连接池和事件循环，之后再调用时重新创建"""
+        self.run(self.client.aclose())
+        self.loop.close()
+
+    @traced
+    def get_bookshelf(self):
+        return self.run(self.client.get_bookshelf())
+
+    @traced
+    def get_notebooklist(self):
+        return self.run(self.client.get_notebooklist())
+
+    def get_bookinfo(self, bookId):
+        return self.run(self.client.get_bookinfo(bookId))
+
+    def get_bookmark_list(self, bookId):
+        return self.run(self.client.get_bookmark_list(bookId))
+
+    def get_read_info(self, bookId):
+        return self.run(self.client.get_read_info(bookId))
+
+    def get_review_list(self, bookId):
+        return self.run(self.client.get_review_list(bookId))
+
+    def get_chapter_info(self, bookId):
+        return self.run(self.client.get_chapter_info(bookId))
+
+    def get_url(self, book_id):
+        return self.client.get_url(book_id)
+
+# ==================== Notion 请求调度 ====================
+
+class TokenBucket:
+    """线程安全的令牌桶，rate 为每秒补充的令牌数"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """取走一个令牌，返回拿到令牌前需要等待的秒数"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """清空令牌，让共享该桶的所有请求至少等待 seconds 秒"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, -seconds * self.rate)
+            self.updated = now
+
+
+# 按 integration token 共用的令牌桶
+notion_buckets = {}
+notion_buckets_lock = threading.Lock()
+
+
+def notion_bucket(token, rate):
+    """返回 token 对应的令牌桶，多个账号用同一个 token 时请求速率合计不超过限速"""
+    with notion_buckets_lock:
+        if token not in notion_buckets:
+            notion_buckets[token] = TokenBucket(rate)
+        return notion_buckets[token]
+
+
+def get_retry_delay(error, attempt):
+    """返回重试前需要等待的秒数，不可重试的错误返回 None"""
+    if isinstance(error, HTTPResponseError):
+        if error.status == 429:
+            try:
+                return float(error.headers.get("Retry-After", 1))
+            except ValueError:
+                return 1
+        if error.status < 500 and error.status not in NOTION_RETRY_STATUSES:
+            return None
+    delay = min(NOTION_BACKOFF_MAX, NOTION_BACKOFF_BASE * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+RETRYABLE_ERRORS = (HTTPResponseError, RequestTimeoutError, httpx.TransportError)
+
+
+def get_retry_wait(bucket, error, attempt, max_retries):
+    """返回本次请求重试前需要等待的秒数，429 时暂停整个令牌桶；不可重试或次数用完时抛出原异常"""
+    delay = get_retry_delay(error, attempt)
+    if delay is None or attempt >= max_retries:
+        raise error
+    if isinstance(error, HTTPResponseError) and error.status == 429:
+        bucket.pause(delay)
+        return 0
+    return delay
+
+
+class NotionClient(Client):
+    """所有请求先从令牌桶取令牌；429 按 Retry-After 暂停，409、5xx 和网络错误按指数退避重试"""
+
+    def __init__(self, bucket, max_retries=NOTION_MAX_RETRIES, metrics=None, **kwargs):
+        super().__init__(**kwargs)
+        self.bucket = bucket
+        self.max_retries = max_retries
+        self.metrics = metrics or Metrics()
+        self.client.event_hooks["response"] = [self.record_response]
+
+    def record_response(self, response):
+        response.read()
+        endpoint = self.metrics.endpoint("notion", response.request.method, response.request.url)
+        self.metrics.record(endpoint, response.status_code, response.elapsed.total_seconds(), len(response.content))
+
+    def request(self, path, method, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                return super().request(path, method, *args, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                time.sleep(get_retry_wait(self.bucket, e, attempt, self.max_retries))
+                self.metrics.retry(self.metrics.endpoint("notion", method.upper(), f"/v1/{path}"))
+                attempt += 1
+
+
+class AsyncNotionClient(AsyncClient):
+    """NotionClient 的异步版本，与同步客户端共用同一个令牌桶；limit 限制同时进行的请求数，需在事件循环里创建"""
+
+    def __init__(self, bucket, max_retries=NOTION_MAX_RETRIES, metrics=None, limit=NOTION_CONCURRENCY, **kwargs):
+        super().__init__(**kwargs)
+        self.bucket = bucket
+        self.max_retries = max_retries
+        self.metrics = metrics or Metrics()
+        self.limit = asyncio.Semaphore(limit)
+        self.client.event_hooks["response"] = [self.record_response]
+
+    async def record_response(self, response):
+        await response.aread()
+        endpoint = self.metrics.endpoint("notion", response.request.method, response.request.url)
+        self.metrics.record(endpoint, response.status_code, response.elapsed.total_seconds(), len(response.content))
+
+    async def request(self, path, method, *args, **kwargs):
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.bucket.reserve())
+            try:
+                async with self.limit:
+                    return await super().request(path, method, *args, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                await asyncio.sleep(get_retry_wait(self.bucket, e, attempt, self.max_retries))
+                self.metrics.retry(self.metrics.endpoint("notion", method.upper(), f"/v1/{path}"))
+                attempt += 1
+
+
+
+class LoopClient:
+    """把异步 Notion 客户端包装成同步接口：接口的每次调用交给事件循环执行并等待结果
+
+    SYNC_ENGINE=async 时替换 NotionHelper.client，追加块、更新页面等请求和异步引擎的批量创建共用同一个 AsyncNotionClient
+    """
+
+    def __init__(self, target, run):
+        self.target = target
+        self.run = run
+
+    def __getattr__(self, name):
+        value = getattr(self.target, name)
+        if isinstance(value, Endpoint):
+            return LoopClient(value, self.run)
+        if callable(value):
+            return lambda *args, **kwargs: self.run(value(*args, **kwargs))
+        return value
+
+# ==================== 本地状态 ====================
+
+class StateStore:
+    """本地 SQLite 状态库，保存书籍页面和笔记块的 ID 映射，避免每次运行全量查询 Notion"""
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS books (
+                    book_id TEXT PRIMARY KEY, page_id TEXT, last_edited_time TEXT, data TEXT
+                );
+                CREATE TABLE IF NOT EXISTS notes (
+                    kind TEXT, page_id TEXT, book_page_id TEXT, note_id TEXT, block_id TEXT,
+                    last_edited_time TEXT, PRIMARY KEY (kind, page_id)
+                );
+                CREATE INDEX IF NOT EXISTS notes_book ON notes (kind, book_page_id);
+                CREATE TABLE IF NOT EXISTS deletions (page_id TEXT PRIMARY KEY, kind TEXT, block_id TEXT);
+                CREATE TABLE IF NOT EXISTS pending_notes (
+                    kind TEXT, book_page_id TEXT, note_id TEXT, block_id TEXT,
+                    PRIMARY KEY (kind, book_page_id, note_id)
+                );
+                CREATE TABLE IF NOT EXISTS checkpoints (scope TEXT, key TEXT, PRIMARY KEY (scope, key));
+                CREATE TABLE IF NOT EXISTS book_properties (
+                    page_id TEXT PRIMARY KEY, last_edited_time TEXT, data TEXT
+                );
+                CREATE TABLE IF NOT EXISTS weread_cache (
+                    key TEXT PRIMARY KEY, version TEXT, fetched_at REAL, data TEXT
+                );
+                CREATE TABLE IF NOT EXISTS weread_sync (
+                    account TEXT, scope TEXT, synckey INTEGER, data TEXT, PRIMARY KEY (account, scope)
+                );
+            """)
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def reset(self):
+        with self.lock, self.conn:
+            # 分片方式说明的是之后写进来的数据属于哪个分片，清空时保留；
+            # pending_notes 记的块已经追加到页面里，对账查不到它们，清掉会在下次运行重复追加
+            self.conn.execute("DELETE FROM meta WHERE key != 'shard'")
+            for table in ("books", "notes", "book_properties", "deletions", "checkpoints"):
+                self.conn.execute(f"DELETE FROM {table}")
+
+    def get_books(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT book_id, data FROM books").fetchall()
+        return {book_id: json.loads(data) for book_id, data in rows}
+
+    def get_book_pages(self):
+        with self.lock:
+            return {page_id for page_id, in self.conn.execute("SELECT page_id FROM books")}
+
+    def save_books(self, rows):
+        """rows 为 (book_id, page_id, last_edited_time, data)"""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?)",
+                [(book_id, page_id, edited, json.dumps(data, ensure_ascii=False))
+                 for book_id, page_id, edited, data in rows],
+            )
+
+    def delete_books(self, page_ids):
+        """删掉书籍页面的映射，连同它的笔记块映射、已追加未入库的笔记和属性摘要"""
+        tables = (("books", "page_id"), ("notes", "book_page_id"), ("pending_notes", "book_page_id"), ("book_properties", "page_id"))
+        with self.lock, self.conn:
+            for table, column in tables:
+                self.conn.executemany(f"DELETE FROM {table} WHERE {column} = ?", [(page_id,) for page_id in page_ids])
+
+    def queue_deletions(self, kind, rows):
+        """rows 为 (page_id, block_id)，从映射中移除并放进待删除队列，删除失败的留在队列里下次重试"""
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM notes WHERE kind = ? AND page_id = ?", [(kind, p) for p, _ in rows])
+            self.conn.executemany("INSERT OR REPLACE INTO deletions VALUES (?, ?, ?)", [(p, kind, b) for p, b in rows])
+
+    def get_deletions(self):
+        """返回待删除的 (page_id, block_id)"""
+        with self.lock:
+            return self.conn.execute("SELECT page_id, block_id FROM deletions").fetchall()
+
+    def remove_deletions(self, rows):
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM deletions WHERE page_id IS ? AND block_id IS ?", rows)
+
+    def get_pending_notes(self, book_page_id):
+        """返回已追加块、还没写入数据库的笔记 {(kind, note_id): block_id}"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT kind, note_id, block_id FROM pending_notes WHERE book_page_id = ?", (book_page_id,)
+            ).fetchall()
+        return {(kind, note_id): block_id for kind, note_id, block_id in rows}
+
+    def save_pending_notes(self, book_page_id, rows):
+        """rows 为 (kind, note_id, block_id)"""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO pending_notes VALUES (?, ?, ?, ?)",
+                [(kind, book_page_id, note_id, block_id) for kind, note_id, block_id in rows],
+            )
+
+    def delete_pending_notes(self, book_page_id, keys):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM pending_notes WHERE kind = ? AND book_page_id = ? AND note_id = ?",
+                [(kind, book_page_id, note_id) for kind, note_id in keys],
+            )
+
+    def get_checkpoint(self, scope):
+        with self.lock:
+            rows = self.conn.execute("SELECT key FROM checkpoints WHERE scope = ?", (scope,)).fetchall()
+        return {key for key, in rows}
+
+    def add_checkpoint(self, scope, keys):
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO checkpoints VALUES (?, ?)", [(scope, key) for key in keys])
+
+    def clear_checkpoint(self, scope):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM checkpoints WHERE scope = ?", (scope,))
+
+    def get_book_properties(self, page_id):
+        """返回上次写入书籍页面的属性哈希；页面在那之后被别处改动过则返回空字典"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT p.data FROM book_properties p JOIN books b"
+                " ON b.page_id = p.page_id AND b.last_edited_time = p.last_edited_time WHERE p.page_id = ?",
+                (page_id,),
+            ).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def save_book_properties(self, page_id, last_edited_time, hashes):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO book_properties VALUES (?, ?, ?)",
+                (page_id, last_edited_time, json.dumps(hashes)),
+            )
+
+    def get_notes(self, kind, book_page_id):
+        """返回某本书的 (page_id, note_id, block_id) 列表"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT page_id, note_id, block_id FROM notes WHERE kind = ? AND book_page_id = ?",
+                (kind, book_page_id),
+            ).fetchall()
+
+    def save_notes(self, kind, rows, replace=False):
+        """rows 为 (page_id, book_page_id, note_id, block_id, last_edited_time)"""
+        with self.lock, self.conn:
+            if replace:
+                self.conn.execute("DELETE FROM notes WHERE kind = ?", (kind,))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO notes VALUES (?, ?, ?, ?, ?, ?)",
+                [(kind, *row) for row in rows],
+            )
+            self.conn.executemany(
+                "DELETE FROM pending_notes WHERE kind = ? AND book_page_id = ? AND note_id = ?",
+                [(kind, book_page_id, note_id) for _, book_page_id, note_id, _, _ in rows],
+            )
+
+    def delete_notes(self, kind, page_ids):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM notes WHERE kind = ? AND page_id = ?",
+                [(kind, page_id) for page_id in page_ids],
+            )
+
+    def get_sync(self, account, scope):
+        """返回微信读书某个范围上次的 (synckey, 合并后的数据)，没有时返回 (0, None)"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT synckey, data FROM weread_sync WHERE account = ? AND scope = ?", (account, scope)
+            ).fetchone()
+        if not row:
+            return 0, None
+        return row[0], json.loads(row[1])
+
+    def save_sync(self, account, scope, synckey, data):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO weread_sync VALUES (?, ?, ?, ?)",
+                (account, scope, synckey, json.dumps(data, ensure_ascii=False)),
+            )
+
+    def get_cache(self, key):
+        """返回缓存的 (version, fetched_at, data)，没有时返回 None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT version, fetched_at, data FROM weread_cache WHERE key = ?", (key,)
+            ).fetchone()
+        if not row:
+            return None
+        return row[0], row[1], json.loads(row[2])
+
+    def save_cache(self, key, version, data):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO weread_cache VALUES (?, ?, ?, ?)",
+                (key, version, time.time(), json.dumps(data, ensure_ascii=False)),
+            )
+
+# ==================== 笔记模型 ====================
+
+def range_start(value):
+    """划线位置 "起-止" 的起点，缺失时为 0"""
+    start = (value or "").split("-")[0]
+    return int(start) if start else 0
+
+
+class Note:
+    """划线、笔记或章节，只保留写入 Notion 需要的字段，排序键在解析时算好"""
+    __slots__ = (
+        "kind", "id", "block_id", "book_id", "chapter_uid", "range", "text", "abstract",
+        "style", "color_style", "type", "star", "book_version", "create_time", "review_id",
+        "chapter_idx", "read_ahead", "update_time", "level", "sort_key",
+    )
+
+    def __init__(self, kind, id, data, text):
+        self.kind = kind
+        self.id = id
+        self.block_id = None
+        self.book_id = data.get("bookId")
+        self.chapter_uid = data.get("chapterUid")
+        self.range = data.get("range")
+        self.text = text
+        self.abstract = data.get("abstract")
+        self.style = data.get("style")
+        self.color_style = data.get("colorStyle")
+        self.type = data.get("type")
+        self.star = data.get("star")
+        self.book_version = data.get("bookVersion")
+        self.create_time = int(data["createTime"]) if "createTime" in data else None
+        self.review_id = data.get("reviewId")
+        self.chapter_idx = data.get("chapterIdx")
+        self.read_ahead = data.get("readAhead")
+        self.update_time = data.get("updateTime")
+        self.level = data.get("level")
+        # 章节在前、同章按位置排序，合成一个整数比较
+        self.sort_key = ((self.chapter_uid or 1) << 32) | range_start(self.range)
+
+    @classmethod
+    def bookmark(cls, data):
+        return cls("bookmark", data.get("bookmarkId"), data, data.get("markText", ""))
+
+    @classmethod
+    def review(cls, data):
+        return cls("review", data.get("reviewId"), data, data.get("content", ""))
+
+    @classmethod
+    def chapter(cls, data):
+        return cls("chapter", data.get("chapterUid"), data, data.get("title"))
+
+
+def parse_notes(chapters, bookmarks, reviews):
+    """拉取到一本书的章节、划线和笔记后立即转成 Note，原始数据不再保留"""
+    return (
+        {uid: Note.chapter(data) for uid, data in (chapters or {}).items()},
+        [Note.bookmark(x) for x in bookmarks or []],
+        [Note.review(x) for x in reviews or []],
+    )
+
+
 # ==================== Notion Helper ====================
 
+class MissingRelation(Exception):
+    """分片同步时作者、分类或日期页面还没建好"""
+
+class StaleAnchor(Exception):
+    """追加笔记时用作锚点的块已经在 Notion 里被删除"""
+
 class NotionHelper:
     database_name_dict = {
         "BOOK_DATABASE_NAME": "魔法学院",
@@ -485,20 +1425,40 @@ class NotionHelper:
         "SETTING_DATABASE_NAME": "设置",
     }
     
-    def __init__(self):
-        self.client = Client(auth=os.getenv("NOTION_TOKEN"), log_level=logging.ERROR)
+    def __init__(self, state=None, metrics=None, config=None):
+        # config 为账号配置，缺省时读环境变量；同一个 token 的各账号共用一个令牌桶
+        self.config = os.environ if config is None else config
+        token = self.config.get("NOTION_TOKEN")
+        rate = float(self.config.get("NOTION_RATE_LIMIT", NOTION_RATE_LIMIT))
+        # 分片在各自的进程里同时运行，共用一个 token，限速按分片数平分
+        self.shard = parse_shard(self.config.get("SYNC_SHARD"))
+        if self.shard:
+            rate /= self.shard[1]
+        self.metrics = metrics or Metrics()
+        self.client = NotionClient(
+            notion_bucket(token, rate), metrics=self.metrics, auth=token, log_level=logging.ERROR
+        )
         self.__cache = {}
-        self.page_id = self.extract_page_id(os.getenv("NOTION_PAGE"))
+        self.__cache_lock = threading.Lock()
+        self.__key_locks = {}
+        self.__preloaded = set()
+        self.__read_records = None
+        self.__anchors = {}
+        self.__pending = {}
+        self.__pending_lock = threading.Lock()
+        self.__read_records_lock = threading.Lock()
+        self.page_id = self.extract_page_id(self.config.get("NOTION_PAGE"))
         self.database_id_dict = {}
         self.show_color = True
         self.block_type = "callout"
         self.sync_bookmark = True
+        self.workers = max(1, int(self.config.get("SYNC_WORKERS", "1")))
+        self.state = state if state is not None else StateStore(self.config.get("STATE_PATH", STATE_PATH))
         
-        self.search_database(self.page_id)
-        
-        for key in self.database_name_dict.keys():
-            if os.getenv(key):
-                self.database_name_dict[key] = os.getenv(key)
+        # 每个实例单独一份名称表，环境变量覆盖后再查找，找齐即可停止遍历
+        self.database_name_dict = {k: self.config.get(k) or v for k, v in self.database_name_dict.items()}
+        if not self.load_database_manifest():
+            self.search_database(self.page_id)
         
         # 按顺序获取或创建数据库
         self.author_database_id = self.get_or_create_database("AUTHOR_DATABASE_NAME", USER_ICON_URL)
@@ -517,19 +1477,67 @@ class NotionHelper:
         if self.setting_database_id:
             self.insert_to_setting_database()
 
+        # 笔记类型 → (数据库, 笔记 ID 属性名)
+        self.note_databases = {
+            "bookmark": (self.bookmark_database_id, "bookmarkId"),
+            "review": (self.review_database_id, "reviewId"),
+            "chapter": (self.chapter_database_id, "chapterUid"),
+        }
+        self.preload_relations()
+        # 换了 Notion 页面或数据库后，旧的映射全部作废
+        if self.state.get_meta("book_database_id") != self.book_database_id:
+            self.state.reset()
+            self.state.set_meta("book_database_id", self.book_database_id)
+        self.save_database_manifest()
+
     def extract_page_id(self, notion_url):
         match = re.search(r"([a-f0-9]{32}|[a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})", notion_url)
         if match:
             return match.group(0)
         raise Exception(f"获取NotionID失败，请检查输入的Url是否正确")
 
+    @traced
     def search_database(self, block_id):
-        children = self.client.blocks.children.list(block_id=block_id)["results"]
-        for child in children:
-            if child["type"] == "child_database":
-                self.database_id_dict[child.get("child_database").get("title")] = child.get("id")
-            if "has_children" in child and child["has_children"]:
-                self.search_database(child["id"])
+        """逐层并发遍历 block_id 下的子块，所有数据库名称都找到后提前结束"""
+        names = set(self.database_name_dict.values())
+        frontier = [block_id]
+        while frontier and not names <= self.database_id_dict.keys():
+            levels = map_in_pool(self.get_all_block_children, frontier, self.workers)
+            frontier = []
+            for children in levels:
+                for child in children:
+                    if child["type"] == "child_database":
+                        self.database_id_dict.setdefault(child.get("child_database").get("title"), child.get("id"))
+                    if child.get("has_children"):
+                        frontier.append(child["id"])
+
+    @traced
+    def load_database_manifest(self):
+        """读取上次解析出的数据库 ID，用一次 search 确认它们都还在且名称未变"""
+        manifest = json.loads(self.state.get_meta(f"databases:{self.page_id}") or "{}")
+        expected = {manifest.get(name): name for name in self.database_name_dict.values()}
+        if None in expected:
+            return False
+        start_cursor = None
+        while expected:
+            response = self.client.search(
+                filter={"property": "object", "value": "database"}, start_cursor=start_cursor, page_size=100
+            )
+            for database in response.get("results"):
+                title = "".join(x.get("plain_text", "") for x in database.get("title", []))
+                if expected.get(database.get("id")) == title and not database.get("archived"):
+                    self.database_id_dict[expected.pop(database.get("id"))] = database.get("id")
+            if not response.get("has_more"):
+                break
+            start_cursor = response.get("next_cursor")
+        if expected:
+            self.database_id_dict = {}
+            return False
+        return True
+
+    def save_database_manifest(self):
+        manifest = {name: self.database_id_dict.get(name) for name in self.database_name_dict.values()}
+        self.state.set_meta(f"databases:{self.page_id}", json.dumps(manifest, ensure_ascii=False))
 
     def get_or_create_database(self, env_key, icon_url, is_main=False):
         name = self.database_name_dict.get(env_key)
@@ -537,14 +1545,17 @@ class NotionHelper:
         
         if db_id:
             print(f"找到数据库: {name}")
-            return db_id
-        
-        print(f"创建数据库: {name}")
-        
-        if is_main:
-            return self.create_book_database(name, icon_url)
+        elif self.shard:
+            # 并行的分片同时创建会建出重复的数据库，统一由 dimensions 创建
+            raise Exception(f"找不到数据库 {name}，分片同步前请先运行 dimensions 创建数据库")
         else:
-            return self.create_simple_database(name, icon_url)
+            print(f"创建数据库: {name}")
+            if is_main:
+                db_id = self.create_book_database(name, icon_url)
+            else:
+                db_id = self.create_simple_database(name, icon_url)
+        self.metrics.names[db_id.replace("-", "")] = name
+        return db_id
 
     def create_simple_database(self, name, icon_url):
         title = [{"type": "text", "text": {"content": name}}]
@@ -577,6 +1588,7 @@ class NotionHelper:
             "书架分类": {"select": {}},
             "我的评分": {"select": {"options": [{"name": "⭐️"}, {"name": "⭐️⭐️⭐️"}, {"name": "⭐️⭐️⭐️⭐️⭐️"}, {"name": "未评分"}]}},
             "豆瓣链接": {"url": {}},
+            "豆瓣短评": {"rich_text": {}},
         }
         parent = {"page_id": self.page_id, "type": "page_id"}
         database = self.client.databases.create(
@@ -660,9 +1672,9 @@ class NotionHelper:
         properties = {
             "标题": {"title": [{"type": "text", "text": {"content": "设置"}}]},
             "最后同步时间": {"date": {"start": pendulum.now("Asia/Shanghai").isoformat()}},
-            "NotinToken": {"rich_text": [{"type": "text", "text": {"content": os.getenv("NOTION_TOKEN")}}]},
-            "NotinPage": {"rich_text": [{"type": "text", "text": {"content": os.getenv("NOTION_PAGE")}}]},
-            "WeReadCookie": {"rich_text": [{"type": "text", "text": {"content": os.getenv("WEREAD_COOKIE")}}]},
+            "NotinToken": {"rich_text": [{"type": "text", "text": {"content": self.config.get("NOTION_TOKEN")}}]},
+            "NotinPage": {"rich_text": [{"type": "text", "text": {"content": self.config.get("NOTION_PAGE")}}]},
+            "WeReadCookie": {"rich_text": [{"type": "text", "text": {"content": self.config.get("WEREAD_COOKIE")}}]},
         }
         
         if existing_pages:
@@ -679,26 +1691,38 @@ class NotionHelper:
             self.client.pages.create(parent={"database_id": self.setting_database_id}, properties=properties)
 
     def get_week_relation_id(self, date):
+        return self.get_relation_id(*self.week_relation(date))
+
+    def get_month_relation_id(self, date):
+        return self.get_relation_id(*self.month_relation(date))
+
+    def get_year_relation_id(self, date):
+        return self.get_relation_id(*self.year_relation(date))
+
+    def get_day_relation_id(self, date):
+        return self.get_relation_id(*self.day_relation(date))
+
+    def week_relation(self, date):
         year = date.isocalendar().year
         week = date.isocalendar().week
         week_str = f"{year}年第{week}周"
         start, end = get_first_and_last_day_of_week(date)
         properties = {"日期": get_date(format_date(start), format_date(end))}
-        return self.get_relation_id(week_str, self.week_database_id, TARGET_ICON_URL, properties)
+        return week_str, self.week_database_id, TARGET_ICON_URL, properties
 
-    def get_month_relation_id(self, date):
+    def month_relation(self, date):
         month_str = date.strftime("%Y年%-m月")
         start, end = get_first_and_last_day_of_month(date)
         properties = {"日期": get_date(format_date(start), format_date(end))}
-        return self.get_relation_id(month_str, self.month_database_id, TARGET_ICON_URL, properties)
+        return month_str, self.month_database_id, TARGET_ICON_URL, properties
 
-    def get_year_relation_id(self, date):
+    def year_relation(self, date):
         year_str = date.strftime("%Y")
         start, end = get_first_and_last_day_of_year(date)
         properties = {"日期": get_date(format_date(start), format_date(end))}
-        return self.get_relation_id(year_str, self.year_database_id, TARGET_ICON_URL, properties)
+        return year_str, self.year_database_id, TARGET_ICON_URL, properties
 
-    def get_day_relation_id(self, date):
+    def day_relation(self, date):
         new_date = date.replace(hour=0, minute=0, second=0, microsecond=0)
         timestamp = (new_date - timedelta(hours=8)).timestamp()
         day_str = new_date.strftime("%Y年%m月%d日")
@@ -709,7 +1733,58 @@ class NotionHelper:
             "月": get_relation([self.get_month_relation_id(new_date)]),
             "周": get_relation([self.get_week_relation_id(new_date)]),
         }
-        return self.get_relation_id(day_str, self.day_database_id, TARGET_ICON_URL, properties)
+        return day_str, self.day_database_id, TARGET_ICON_URL, properties
+
+    @traced
+    def preload_relations(self):
+        """一次性分页扫描作者、分类和年月周日数据库，建立 名称 → page_id 索引"""
+        database_ids = [
+            self.author_database_id, self.category_database_id, self.year_database_id,
+            self.month_database_id, self.week_database_id, self.day_database_id,
+        ]
+        database_ids = [x for x in database_ids if x]
+        for database_id, results in zip(database_ids, map_in_pool(self.query_all, database_ids, len(database_ids))):
+            for result in results:
+                name = get_property_value(result.get("properties").get("标题"))
+                if name:
+                    self.__cache.setdefault(f"{database_id}{name}", result.get("id"))
+            self.__preloaded.add(database_id)
+
+    def missing_days(self, dates):
+        """返回还没有日期页面的日子"""
+        missing = {}
+        for date in dates:
+            day = date.replace(hour=0, minute=0, second=0, microsecond=0)
+            key = f"{self.day_database_id}{day.strftime('%Y年%m月%d日')}"
+            if key not in self.__cache:
+                missing.setdefault(key, day)
+        return list(missing.values())
+
+    def calendar_relations(self, days):
+        """返回这些日子依赖的年、月、周页面，三者之间互不依赖，可以一起创建"""
+        relations = [self.year_relation(d) for d in {d.year: d for d in days}.values()]
+        relations += [self.month_relation(d) for d in {(d.year, d.month): d for d in days}.values()]
+        relations += [self.week_relation(d) for d in {d.isocalendar()[:2]: d for d in days}.values()]
+        return relations
+
+    @traced
+    def build_calendar(self, dates, workers=1):
+        """按 年、月、周 → 日 的依赖顺序批量创建缺失的日期页面，之后的日期关联都能直接命中缓存"""
+        days = self.missing_days(dates)
+        if not days:
+            return
+        print(f"创建日期页面，共{len(days)}天")
+        list(map_in_pool(lambda args: self.get_relation_id(*args), self.calendar_relations(days), workers))
+        list(map_in_pool(self.get_day_relation_id, days, workers))
+
+    def cached_relation_id(self, name, id):
+        return self.__cache.get(f"{id}{name}")
+
+    def cache_relation_id(self, name, id, page_id):
+        self.__cache[f"{id}{name}"] = page_id
+
+    def is_preloaded(self, id):
+        return id in self.__preloaded
 
     def get_relation_id(self, name, id, icon, properties=None):
         if properties is None:
@@ -717,168 +1792,413 @@ class NotionHelper:
         key = f"{id}{name}"
         if key in self.__cache:
             return self.__cache.get(key)
-        filter = {"property": "标题", "title": {"equals": name}}
-        response = self.client.databases.query(database_id=id, filter=filter)
-        if len(response.get("results")) == 0:
-            parent = {"database_id": id, "type": "database_id"}
-            properties["标题"] = get_title(name)
-            page_id = self.client.pages.create(parent=parent, properties=properties, icon=get_icon(icon)).get("id")
-        else:
-            page_id = response.get("results")[0].get("id")
-        self.__cache[key] = page_id
+        # 同名条目加锁，避免多个线程同时查询不到而重复创建
+        with self.__cache_lock:
+            key_lock = self.__key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key in self.__cache:
+                return self.__cache.get(key)
+            # 已预加载的数据库里查不到就说明不存在
+            if self.is_preloaded(id):
+                response = {"results": []}
+            else:
+                filter = {"property": "标题", "title": {"equals": name}}
+                response = self.client.databases.query(database_id=id, filter=filter)
+            if len(response.get("results")) == 0:
+                # 分片同步时作者、分类和日期页面由 dimensions 步骤统一创建，各分片只查不建，避免重复
+                if self.shard:
+                    raise MissingRelation(f"{name} 页面还没有创建，请先运行 dimensions")
+                parent = {"database_id": id, "type": "database_id"}
+                properties["标题"] = get_title(name)
+                page_id = self.client.pages.create(parent=parent, properties=properties, icon=get_icon(icon)).get("id")
+            else:
+                page_id = response.get("results")[0].get("id")
+            self.__cache[key] = page_id
         return page_id
 
     def insert_bookmark(self, id, bookmark):
+        result = self.create_page(*self.bookmark_page(id, bookmark))
+        self.save_note("bookmark", id, bookmark.id, bookmark.block_id, result)
+
+    def insert_review(self, id, review):
+        result = self.create_page(*self.review_page(id, review))
+        self.save_note("review", id, review.id, review.block_id, result)
+
+    def insert_chapter(self, id, chapter):
+        result = self.create_page(*self.chapter_page(id, chapter))
+        self.save_note("chapter", id, chapter.id, chapter.block_id, result)
+
+    def note_page(self, id, note):
+        """返回 (笔记类型, 笔记 ID, (parent, properties, icon))"""
+        pages = {"bookmark": self.bookmark_page, "review": self.review_page, "chapter": self.chapter_page}
+        return note.kind, note.id, pages[note.kind](id, note)
+
+    def bookmark_page(self, id, bookmark):
         icon = get_icon(BOOKMARK_ICON_URL)
         properties = {
-            "Name": get_title(bookmark.get("markText", "")),
-            "bookId": get_rich_text(bookmark.get("bookId")),
-            "range": get_rich_text(bookmark.get("range")),
-            "bookmarkId": get_rich_text(bookmark.get("bookmarkId")),
-            "blockId": get_rich_text(bookmark.get("blockId")),
-            "chapterUid": get_number(bookmark.get("chapterUid")),
-            "bookVersion": get_number(bookmark.get("bookVersion")),
-            "colorStyle": get_number(bookmark.get("colorStyle")),
-            "type": get_number(bookmark.get("type")),
-            "style": get_number(bookmark.get("style")),
+            "Name": get_title(bookmark.text),
+            "bookId": get_rich_text(bookmark.book_id),
+            "range": get_rich_text(bookmark.range),
+            "bookmarkId": get_rich_text(bookmark.id),
+            "blockId": get_rich_text(bookmark.block_id),
+            "chapterUid": get_number(bookmark.chapter_uid),
+            "bookVersion": get_number(bookmark.book_version),
+            "colorStyle": get_number(bookmark.color_style),
+            "type": get_number(bookmark.type),
+            "style": get_number(bookmark.style),
             "书籍": get_relation([id]),
         }
-        if "createTime" in bookmark:
-            create_time = timestamp_to_date(int(bookmark.get("createTime")))
+        if bookmark.create_time is not None:
+            create_time = timestamp_to_date(bookmark.create_time)
             properties["Date"] = get_date(create_time.strftime("%Y-%m-%d %H:%M:%S"))
             self.get_date_relation(properties, create_time)
         parent = {"database_id": self.bookmark_database_id, "type": "database_id"}
-        self.create_page(parent, properties, icon)
+        return parent, properties, icon
 
-    def insert_review(self, id, review):
-        time.sleep(0.1)
+    def review_page(self, id, review):
         icon = get_icon(TAG_ICON_URL)
         properties = {
-            "Name": get_title(review.get("content", "")),
-            "bookId": get_rich_text(review.get("bookId")),
-            "reviewId": get_rich_text(review.get("reviewId")),
-            "blockId": get_rich_text(review.get("blockId")),
-            "chapterUid": get_number(review.get("chapterUid")),
-            "bookVersion": get_number(review.get("bookVersion")),
-            "type": get_number(review.get("type")),
+            "Name": get_title(review.text),
+            "bookId": get_rich_text(review.book_id),
+            "reviewId": get_rich_text(review.id),
+            "blockId": get_rich_text(review.block_id),
+            "chapterUid": get_number(review.chapter_uid),
+            "bookVersion": get_number(review.book_version),
+            "type": get_number(review.type),
             "书籍": get_relation([id]),
         }
-        if "range" in review:
-            properties["range"] = get_rich_text(review.get("range"))
-        if "star" in review:
-            properties["star"] = get_number(review.get("star"))
-        if "abstract" in review:
-            properties["abstract"] = get_rich_text(review.get("abstract"))
-        if "createTime" in review:
-            create_time = timestamp_to_date(int(review.get("createTime")))
+        if review.range is not None:
+            properties["range"] = get_rich_text(review.range)
+        if review.star is not None:
+            properties["star"] = get_number(review.star)
+        if review.abstract is not None:
+            properties["abstract"] = get_rich_text(review.abstract)
+        if review.create_time is not None:
+            create_time = timestamp_to_date(review.create_time)
             properties["Date"] = get_date(create_time.strftime("%Y-%m-%d %H:%M:%S"))
             self.get_date_relation(properties, create_time)
         parent = {"database_id": self.review_database_id, "type": "database_id"}
-        self.create_page(parent, properties, icon)
+        return parent, properties, icon
 
-    def insert_chapter(self, id, chapter):
-        time.sleep(0.1)
+    def chapter_page(self, id, chapter):
         icon = {"type": "external", "external": {"url": TAG_ICON_URL}}
         properties = {
-            "Name": get_title(chapter.get("title")),
-            "blockId": get_rich_text(chapter.get("blockId")),
-            "chapterUid": {"number": chapter.get("chapterUid")},
-            "chapterIdx": {"number": chapter.get("chapterIdx")},
-            "readAhead": {"number": chapter.get("readAhead")},
-            "updateTime": {"number": chapter.get("updateTime")},
-            "level": {"number": chapter.get("level")},
+            "Name": get_title(chapter.text),
+            "blockId": get_rich_text(chapter.block_id),
+            "chapterUid": {"number": chapter.id},
+            "chapterIdx": {"number": chapter.chapter_idx},
+            "readAhead": {"number": chapter.read_ahead},
+            "updateTime": {"number": chapter.update_time},
+            "level": {"number": chapter.level},
             "书籍": {"relation": [{"id": id}]},
         }
         parent = {"database_id": self.chapter_database_id, "type": "database_id"}
-        self.create_page(parent, properties, icon)
+        return parent, properties, icon
+
+    def save_note(self, kind, book_page_id, note_id, block_id, result):
+        row = (result.get("id"), book_page_id, str(note_id), block_id, result.get("last_edited_time"))
+        self.state.save_notes(kind, [row])
+
+    def get_notes(self, kind, book_page_id):
+        return self.state.get_notes(kind, book_page_id)
+
+    def delete_notes(self, kind, rows):
+        """把过期笔记的数据库条目和页面里的笔记块 (page_id, block_id) 放进待删除队列，由 delete_queued 统一删除"""
+        if rows:
+            self.state.queue_deletions(kind, rows)
+
+    @traced
+    def delete_queued(self, workers=1):
+        """并发删除队列中的笔记，包括以前删除失败的；成功的移出队列，失败的留到下次运行"""
+        rows = self.state.get_deletions()
+        if not rows:
+            return
+        print(f"删除过期笔记，共{len(rows)}条")
+
+        def delete(row):
+            try:
+                for id in row:
+                    if id:
+                        self.delete_if_exists(id)
+            except Exception as e:
+                return e
+
+        step = max(1, len(rows) // 10)
+        deleted = []
+        failed = 0
+        for index, (row, error) in enumerate(zip(rows, map_in_pool(delete, rows, workers))):
+            if error:
+                failed += 1
+                print(f"::warning::删除 {row[0] or row[1]} 失败，下次运行时重试: {error}")
+            else:
+                deleted.append(row)
+            if (index + 1) % step == 0 or index + 1 == len(rows):
+                print(f"已删除{len(deleted)}条，失败{failed}条，共{len(rows)}条")
+        self.state.remove_deletions(deleted)
+
+    def drop_note(self, book_page_id, note):
+        """笔记块已在 Notion 里被删除：去掉本地映射和追加记录，数据库条目放进删除队列"""
+        rows = [(row_id, None) for row_id, _, block_id in self.state.get_notes(note.kind, book_page_id)
+                if block_id == note.block_id]
+        self.delete_notes(note.kind, rows)
+        self.state.delete_pending_notes(book_page_id, [(note.kind, str(note.id))])
+
+    def delete_if_exists(self, block_id):
+        """删除块或页面，已经不存在或已被删除时视为成功"""
+        try:
+            self.delete_block(block_id)
+        except HTTPResponseError as e:
+            if not (e.status == 404 or (e.status == 400 and "archived" in str(e))):
+                raise
+
+    def changed_properties(self, page_id, properties):
+        """只保留和上次写入时不同的属性"""
+        hashes = self.state.get_book_properties(page_id)
+        return {k: v for k, v in properties.items() if hashes.get(k) != get_property_hash(v)}
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def update_book_page(self, page_id, properties):
-        return self.client.pages.update(page_id=page_id, properties=properties)
+        """把书籍页面的属性改动放进写缓冲，同一页面在一次运行中的多次改动合并，由 flush_updates 一次写入"""
+        if not properties:
+            return
+        with self.__pending_lock:
+            self.__pending.setdefault(page_id, {}).update(properties)
+
+    @traced
+    def flush_updates(self, workers=1):
+        """写入缓冲中的页面改动，单个页面失败只打印警告，不影响其他页面；返回写入失败的页面 ID"""
+        with self.__pending_lock:
+            pending, self.__pending = self.__pending, {}
+        failed = set()
+        if not pending:
+            return failed
+        print(f"更新书籍页面，共{len(pending)}个")
+
+        def write(item):
+            try:
+                self.write_book_page(*item)
+            except Exception as e:
+                return e
+
+        for page_id, error in zip(pending, map_in_pool(write, pending.items(), workers)):
+            if error:
+                print(f"::warning::书籍页面 {page_id} 更新失败，下次运行时重试: {error}")
+                failed.add(page_id)
+        return failed
+
+    def write_book_page(self, page_id, properties):
+        """更新书籍页面并记录各属性的哈希"""
+        hashes = self.state.get_book_properties(page_id)
+        result = self.client.pages.update(page_id=page_id, properties=properties)
+        hashes.update({k: get_property_hash(v) for k, v in properties.items()})
+        self.state.save_book_properties(page_id, result.get("last_edited_time"), hashes)
+        return result
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def update_page(self, page_id, properties, icon=None):
         return self.client.pages.update(page_id=page_id, properties=properties, icon=icon)
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def create_page(self, parent, properties, icon):
         return self.client.pages.create(parent=parent, properties=properties, icon=icon)
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def create_book_page(self, parent, properties, icon):
-        return self.client.pages.create(parent=parent, properties=properties, icon=icon)
+        result = self.client.pages.create(parent=parent, properties=properties, icon=icon)
+        hashes = {k: get_property_hash(v) for k, v in properties.items()}
+        self.state.save_book_properties(result.get("id"), result.get("last_edited_time"), hashes)
+        return result
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def query(self, **kwargs):
         kwargs = {k: v for k, v in kwargs.items() if v}
         return self.client.databases.query(**kwargs)
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def get_block_children(self, id):
         response = self.client.blocks.children.list(id)
         return response.get("results")
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    def get_all_block_children(self, block_id):
+        results = []
+        has_more = True
+        start_cursor = None
+        while has_more:
+            response = self.client.blocks.children.list(block_id=block_id, start_cursor=start_cursor, page_size=100)
+            start_cursor = response.get("next_cursor")
+            has_more = response.get("has_more")
+            results.extend(response.get("results"))
+        return results
+
     def append_blocks(self, block_id, children):
         return self.client.blocks.children.append(block_id=block_id, children=children)
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def append_blocks_after(self, block_id, children, after):
-        parent = self.client.blocks.retrieve(after).get("parent")
-        if parent.get("type") == "block_id":
-            after = parent.get("block_id")
-        return self.client.blocks.children.append(block_id=block_id, children=children, after=after)
+        """锚点一般就是页面的直接子块，先直接追加；锚点被挪进了其他块时 Notion 返回 400，
+        这时再查一次它的父块，并记下结果供后面的追加复用；锚点已被删除时抛出 StaleAnchor"""
+        after = self.__anchors.get(after, after)
+        try:
+            return self.client.blocks.children.append(block_id=block_id, children=children, after=after)
+        except HTTPResponseError as e:
+            if e.status != 400:
+                raise
+            try:
+                block = self.client.blocks.retrieve(after)
+            except HTTPResponseError as error:
+                if error.status != 404:
+                    raise
+                block = {"archived": True}
+            if block.get("archived") or block.get("in_trash"):
+                raise StaleAnchor(after) from e
+            parent = block.get("parent")
+            if parent.get("type") != "block_id":
+                raise
+        self.__anchors[after] = parent.get("block_id")
+        return self.client.blocks.children.append(block_id=block_id, children=children, after=parent.get("block_id"))
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def delete_block(self, block_id):
         return self.client.blocks.delete(block_id=block_id)
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    def query_changed(self, database_id):
+        """查询上次对账以来改动过的条目，首次或距上次全量超过 STATE_FULL_SYNC_DAYS 天时全量查询
+
+        返回 (pages, full, watermark)，pages 逐页产出查询结果，调用方写入本地状态后再用 watermark 调用 mark_synced
+        """
+        synced = self.state.get_meta(f"synced:{database_id}")
+        full_synced = self.state.get_meta(f"full_synced:{database_id}")
+        now = pendulum.now("UTC")
+        full_days = int(self.config.get("STATE_FULL_SYNC_DAYS", STATE_FULL_SYNC_DAYS))
+        full = synced is None or full_synced is None or (now - pendulum.parse(full_synced)).in_days() >= full_days
+        if full:
+            # 全量对账时调用方先清空本地映射再逐页写入，中途中断的话下次运行仍然全量查询
+            self.state.set_meta(f"full_synced:{database_id}", None)
+            pages = self.query_pages(database_id)
+        else:
+            filter = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": synced}}
+            pages = self.query_pages(database_id, filter)
+        # last_edited_time 精度为分钟，水位线往前留出余量
+        watermark = now.subtract(minutes=2).to_iso8601_string()
+        return pages, full, watermark
+
+    def mark_synced(self, database_id, full, watermark):
+        self.state.set_meta(f"synced:{database_id}", watermark)
+        if full:
+            self.state.set_meta(f"full_synced:{database_id}", watermark)
+
+    @traced
     def get_all_book(self):
-        results = self.query_all(self.book_database_id)
-        books_dict = {}
-        for result in results:
-            bookId = get_property_value(result.get("properties").get("BookId"))
-            books_dict[bookId] = {
-                "pageId": result.get("id"),
-                "readingTime": get_property_value(result.get("properties").get("阅读时长")),
-                "category": get_property_value(result.get("properties").get("书架分类")),
-                "Sort": get_property_value(result.get("properties").get("Sort")),
-                "douban_url": get_property_value(result.get("properties").get("豆瓣链接")),
-                "cover": result.get("cover"),
-                "myRating": get_property_value(result.get("properties").get("我的评分")),
-                "comment": get_property_value(result.get("properties").get("豆瓣短评")),
-                "status": get_property_value(result.get("properties").get("阅读状态")),
-            }
-        return books_dict
+        """每次运行逐页扫描书籍数据库写入本地映射，每 100 本一次请求；划线和笔记数据库才按改动增量对账
+
+        本地有、扫描不到的书籍页面已在 Notion 里被删除，删掉它的映射、笔记条目和阅读记录，之后当作新书重新创建
+        """
+        stored = self.state.get_book_pages()
+        for results in self.query_pages(self.book_database_id):
+            rows = []
+            for result in results:
+                stored.discard(result.get("id"))
+                bookId = get_property_value(result.get("properties").get("BookId"))
+                if not bookId:
+                    continue
+                rows.append((bookId, result.get("id"), result.get("last_edited_time"), self.parse_book(result)))
+            self.state.save_books(rows)
+        if stored:
+            print(f"{len(stored)}个书籍页面已在 Notion 里被删除，重新创建")
+            # 旧页面的划线、笔记和章节条目放进删除队列，重新创建的页面会写入新的条目
+            for kind in self.note_databases:
+                rows = [(row_id, None) for page_id in stored for row_id, _, _ in self.state.get_notes(kind, page_id)]
+                self.delete_notes(kind, rows)
+            # 阅读记录按书籍页面建索引，旧页面的记录也一并删除，由新页面重新写入
+            records = self.get_read_records()
+            stale = [key for key in records if key[0] in stored]
+            self.delete_notes("read", [(records.pop(key)[0], None) for key in stale])
+            self.state.delete_books(stored)
+        return self.state.get_books()
+
+    def parse_book(self, result):
+        return {
+            "pageId": result.get("id"),
+            "readingTime": get_property_value(result.get("properties").get("阅读时长")),
+            "category": get_property_value(result.get("properties").get("书架分类")),
+            "Sort": get_property_value(result.get("properties").get("Sort")),
+            "douban_url": get_property_value(result.get("properties").get("豆瓣链接")),
+            "cover": result.get("cover"),
+            "myRating": get_property_value(result.get("properties").get("我的评分")),
+            "comment": get_property_value(result.get("properties").get("豆瓣短评")),
+            "status": get_property_value(result.get("properties").get("阅读状态")),
+        }
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
-    def query_all_by_book(self, database_id, filter):
-        results = []
+    @traced
+    def reconcile_notes(self):
+        """把划线、笔记、章节数据库的改动同步到本地 ID 映射"""
+        for kind, (database_id, id_name) in self.note_databases.items():
+            pages, full, watermark = self.query_changed(database_id)
+            if full:
+                self.state.save_notes(kind, [], replace=True)
+            # 每页写入一次本地状态，全量对账时也不把整个数据库留在内存里
+            for results in pages:
+                rows = []
+                removed = []
+                for result in results:
+                    properties = result.get("properties")
+                    block_id = get_property_value(properties.get("blockId"))
+                    books = properties.get("书籍", {}).get("relation") or []
+                    if not block_id or not books:
+                        removed.append(result.get("id"))
+                        continue
+                    note_id = get_property_value(properties.get(id_name))
+                    rows.append((result.get("id"), books[0].get("id"), str(note_id), block_id, result.get("last_edited_time")))
+                self.state.save_notes(kind, rows)
+                self.state.delete_notes(kind, removed)
+            self.mark_synced(database_id, full, watermark)
+
+    def query_pages(self, database_id, filter=None):
+        """逐页产出查询结果，每页最多 100 条，调用方处理完一页再请求下一页"""
         has_more = True
         start_cursor = None
         while has_more:
-            response = self.client.databases.query(
-                database_id=database_id, filter=filter, start_cursor=start_cursor, page_size=100
-            )
+            response = self.query(database_id=database_id, filter=filter, start_cursor=start_cursor, page_size=100)
             start_cursor = response.get("next_cursor")
             has_more = response.get("has_more")
-            results.extend(response.get("results"))
-        return results
+            yield response.get("results")
+
+    def query_all_by_book(self, database_id, filter):
+        return [result for results in self.query_pages(database_id, filter) for result in results]
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def query_all(self, database_id):
-        results = []
-        has_more = True
-        start_cursor = None
-        while has_more:
-            response = self.client.databases.query(
-                database_id=database_id, start_cursor=start_cursor, page_size=100
-            )
-            start_cursor = response.get("next_cursor")
-            has_more = response.get("has_more")
-            results.extend(response.get("results"))
-        return results
+        return [result for results in self.query_pages(database_id) for result in results]
+
+    def get_read_records(self):
+        """整个运行只扫描一次阅读记录数据库，返回 {(书籍页面 ID, 时间戳): (记录页面 ID, 时长)}"""
+        with self.__read_records_lock:
+            if self.__read_records is None:
+                records = {}
+                for results in self.query_pages(self.read_database_id):
+                    for result in results:
+                        properties = result.get("properties")
+                        books = properties.get("书架", {}).get("relation") or []
+                        timestamp = get_property_value(properties.get("时间戳"))
+                        if books and timestamp is not None:
+                            value = (result.get("id"), get_property_value(properties.get("时长")))
+                            records.setdefault((books[0].get("id"), timestamp), value)
+                self.__read_records = records
+        return self.__read_records
+
+    @traced
+    def write_read_records(self, records, workers=1):
+        """records 为 (记录页面 ID 或 None, 书籍页面 ID, 时间戳, 时长)，没有页面 ID 的新建，速率由令牌桶控制"""
+        index = self.get_read_records()
+        parent = {"database_id": self.read_database_id, "type": "database_id"}
+
+        def write(record):
+            page_id, book_page_id, timestamp, duration = record
+            properties = {
+                "标题": get_title(pendulum.from_timestamp(timestamp, tz=tz).to_date_string()),
+                "日期": get_date(start=pendulum.from_timestamp(timestamp, tz=tz).format("YYYY-MM-DD HH:mm:ss")),
+                "时长": get_number(duration),
+                "时间戳": get_number(timestamp),
+                "书架": get_relation([book_page_id]),
+            }
+            if page_id:
+                self.client.pages.update(page_id=page_id, properties=properties)
+            else:
+                page_id = self.create_page(parent, properties, get_icon(TARGET_ICON_URL)).get("id")
+            index[(book_page_id, timestamp)] = (page_id, duration)
+
+        list(map_in_pool(write, records, workers))
 
     def get_date_relation(self, properties, date):
         properties["年"] = get_relation([self.get_year_relation_id(date)])
@@ -886,30 +2206,251 @@ class NotionHelper:
         properties["周"] = get_relation([self.get_week_relation_id(date)])
         properties["日"] = get_relation([self.get_day_relation_id(date)])
 
+# ==================== 异步引擎 ====================
+
+class AsyncEngine:
+    """在微信读书客户端的事件循环里并发拉取微信读书数据、批量创建 Notion 页面
+
+    微信读书请求直接并发调用 AsyncWeReadApi 的协程，与同步调用共用同一个并发上限；
+    运行期间 NotionHelper.client 换成包装 AsyncNotionClient 的 LoopClient，追加块等请求也走事件循环，
+    Notion 请求与同步客户端共用令牌桶，总速率不变
+    """
+
+    def __init__(self, weread_api, notion_helper):
+        self.weread_api = weread_api
+        self.weread = weread_api.client
+        self.notion_helper = notion_helper
+        self.metrics = notion_helper.metrics
+        self.relation_tasks = {}
+
+    def start(self):
+        self.run(self.open())
+        self.sync_client = self.notion_helper.client
+        self.notion_helper.client = LoopClient(self.client, self.run)
+
+    def run(self, coro):
+        """在事件循环中执行协程并等待结果，可在任意线程调用"""
+        return self.weread_api.run(coro)
+
+    def close(self):
+        self.notion_helper.client = self.sync_client
+        self.run(self.client.aclose())
+
+    async def open(self):
+        config = self.notion_helper.config
+        client = self.notion_helper.client
+        self.client = AsyncNotionClient(
+            client.bucket, client.max_retries, metrics=client.metrics,
+            limit=int(config.get("NOTION_CONCURRENCY", NOTION_CONCURRENCY)),
+            auth=client.options.auth, log_level=logging.ERROR,
+        )
+
+    # ---------- 微信读书 ----------
+
+    async def fetch_book(self, bookId):
+        return await asyncio.gather(self.weread.get_bookinfo(bookId), self.weread.get_read_info(bookId))
+
+    async def fetch_book_notes(self, bookId):
+        return parse_notes(*await asyncio.gather(
+            self.weread.get_chapter_info(bookId),
+            self.weread.get_bookmark_list(bookId),
+            self.weread.get_review_list(bookId),
+        ))
+
+    @traced
+    def fetch_books(self, bookIds):
+        """并发拉取书籍详情和阅读信息，返回 {bookId: (bookInfo, readInfo) 或异常}"""
+        async def fetch():
+            return await asyncio.gather(*map(self.fetch_book, bookIds), return_exceptions=True)
+        return dict(zip(bookIds, self.run(fetch())))
+
+    @traced
+    def fetch_notes(self, bookIds):
+        """并发拉取各书的章节、划线和笔记，返回 {bookId: (chapter, bookmarks, reviews) 或异常}"""
+        async def fetch():
+            return await asyncio.gather(*map(self.fetch_book_notes, bookIds), return_exceptions=True)
+        return dict(zip(bookIds, self.run(fetch())))
+
+    # ---------- Notion ----------
+
+    async def create_page(self, parent, properties, icon):
+        return await self.client.pages.create(parent=parent, properties=properties, icon=icon)
+
+    async def get_relation_id(self, name, id, icon, properties=None):
+        """多本书同时建日期页面时，同名页面共用一个任务，只查询、创建一次"""
+        key = (name, id)
+        task = self.relation_tasks.get(key)
+        if task is None:
+            task = self.relation_tasks[key] = asyncio.ensure_future(self.find_relation_id(name, id, icon, properties))
+        try:
+            return await task
+        except Exception:
+            # 失败的任务不留着，下次调用重新查询
+            if self.relation_tasks.get(key) is task:
+                del self.relation_tasks[key]
+            raise
+
+    async def find_relation_id(self, name, id, icon, properties=None):
+        helper = self.notion_helper
+        page_id = helper.cached_relation_id(name, id)
+        if page_id:
+            return page_id
+        response = {"results": []}
+        if not helper.is_preloaded(id):
+            filter = {"property": "标题", "title": {"equals": name}}
+            response = await self.client.databases.query(database_id=id, filter=filter)
+        if response.get("results"):
+            page_id = response.get("results")[0].get("id")
+        elif helper.shard:
+            raise MissingRelation(f"{name} 页面还没有创建，请先运行 dimensions")
+        else:
+            properties = dict(properties or {}, 标题=get_title(name))
+            page_id = (await self.create_page({"database_id": id, "type": "database_id"}, properties, get_icon(icon))).get("id")
+        helper.cache_relation_id(name, id, page_id)
+        return page_id
+
+    @traced
+    def build_calendar(self, dates):
+        """与 NotionHelper.build_calendar 相同，年、月、周页面和日页面各一轮并发创建"""
+        helper = self.notion_helper
+        days = helper.missing_days(dates)
+        if not days:
+            return
+        print(f"创建日期页面，共{len(days)}天")
+
+        async def build():
+            await asyncio.gather(*[self.get_relation_id(*args) for args in helper.calendar_relations(days)])
+            await asyncio.gather(*[self.get_relation_id(*helper.day_relation(day)) for day in days])
+        self.run(build())
+
+    @traced
+    def create_notes(self, book_page_id, contents):
+        """并发创建一本书的笔记条目并记录 ID 映射"""
+        pages = [self.notion_helper.note_page(book_page_id, content) for content in contents]
+
+        async def create():
+            return await asyncio.gather(*[self.create_page(*page) for _, _, page in pages], return_exceptions=True)
+        # 已创建成功的条目先记下映射，再抛出第一个错误，避免下次重复创建
+        errors = []
+        for (kind, note_id, _), content, result in zip(pages, contents, self.run(create())):
+            if isinstance(result, Exception):
+                errors.append(result)
+                continue
+            self.notion_helper.save_note(kind, book_page_id, note_id, content.block_id, result)
+        if errors:
+            raise errors[0]
+
 # ==================== 同步功能 ====================
 
+# 超出时间预算、留到下次运行的书
+DEFERRED = object()
+
+
 class WeReadSync:
-    def __init__(self):
-        self.weread_api = WeReadApi()
-        self.notion_helper = NotionHelper()
+    def __init__(self, metrics=None, config=None):
+        # config 为账号配置，缺省时读环境变量
+        self.config = os.environ if config is None else config
+        self.state = StateStore(self.config.get("STATE_PATH", STATE_PATH))
+        self.shard = parse_shard(self.config.get("SYNC_SHARD"))
+        # 状态库只记录本分片的书，分片方式变了就清空重新对账，否则会漏掉新分到的书已有的笔记
+        shard = f"{self.shard[0]}/{self.shard[1]}" if self.shard else ""
+        if (self.state.get_meta("shard") or "") != shard:
+            print(f"分片方式改为 {shard or '不分片'}，重新对账本地状态")
+            self.state.reset()
+            self.state.set_meta("shard", shard)
+        self.metrics = metrics or Metrics()
+        self.weread_api = WeReadApi(self.state, self.metrics, self.config)
+        self.notion_helper = NotionHelper(self.state, self.metrics, self.config)
         self.archive_dict = {}
         self.notion_books = {}
-
-    def insert_book_to_notion(self, books, index, bookId):
+        self.workers = max(1, int(self.config.get("SYNC_WORKERS", "1")))
+        self.engine = None
+        self.read_records = []
+        self.budget = float(self.config.get("SYNC_TIME_BUDGET") or 0)
+        self.deadline = None
+
+    def fetch_book(self, bookId, fetched=None):
+        """返回 (bookInfo, readInfo)，异步引擎预取过的直接使用"""
+        if isinstance(fetched, Exception):
+            raise fetched
+        if fetched is not None:
+            return fetched
+        return self.weread_api.get_bookinfo(bookId), self.weread_api.get_read_info(bookId)
+
+    def out_of_time(self):
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def map_books(self, func, bookIds, fetch=None, prepare=None):
+        """并发执行 func(bookId, fetched)，按 bookIds 的顺序产出结果
+
+        fetch 为批量拉取，每次只预取 PREFETCH_BOOKS 本，这批处理完、时间预算还有剩余才预取下一批，
+        排在后面、超出预算的书不会被拉取；prepare(fetched) 在这批书开始处理前执行；
+        没有 fetch 时 fetched 为 None，由 func 自己拉取
+        """
+        size = PREFETCH_BOOKS if fetch else max(1, len(bookIds))
+        for start in range(0, len(bookIds), size):
+            batch = bookIds[start:start + size]
+            fetched = fetch(batch) if fetch and not self.out_of_time() else {}
+            if prepare:
+                prepare(fetched)
+            yield from map_in_pool(lambda bookId: func(bookId, fetched.get(bookId)), batch, self.workers)
+
+    def fetch_books(self, bookIds):
+        """并发拉取书籍详情和阅读信息，返回 {bookId: (bookInfo, readInfo) 或异常}"""
+        def fetch(bookId):
+            try:
+                return self.fetch_book(bookId)
+            except Exception as e:
+                return e
+        return dict(zip(bookIds, map_in_pool(fetch, bookIds, self.workers)))
+
+    def book_priority(self, bookId, progress):
+        """最近读过、阅读时长增加多的书排在前面"""
+        item = progress.get(bookId, {})
+        delta = (item.get("readingTime") or 0) - (self.notion_books.get(bookId, {}).get("readingTime") or 0)
+        return -(item.get("updateTime") or 0), -delta, bookId
+
+    def load_book(self, bookId, fetched=None):
+        """合并 Notion 里已有的属性、书籍信息和阅读信息"""
         book = {}
         if bookId in self.archive_dict:
             book["书架分类"] = self.archive_dict.get(bookId)
         if bookId in self.notion_books:
             book.update(self.notion_books.get(bookId))
         
-        bookInfo = self.weread_api.get_bookinfo(bookId)
+        bookInfo, readInfo = self.fetch_book(bookId, fetched)
         if bookInfo:
             book.update(bookInfo)
         
-        readInfo = self.weread_api.get_read_info(bookId)
         readInfo.update(readInfo.get("readDetail", {}))
         readInfo.update(readInfo.get("bookInfo", {}))
         book.update(readInfo)
+        return book
+
+    def book_date(self, book):
+        """书籍页面 时间 属性的时间戳"""
+        return book.get("finishedDate") or book.get("lastReadingDate") or book.get("readingBookDate")
+
+    def book_dates(self, fetched):
+        """这批书 时间 属性的日期，和 write_book 关联日期页面时的换算一致"""
+        dates = [
+            self.book_date(self.load_book(bookId, result))
+            for bookId, result in fetched.items() if not isinstance(result, Exception)
+        ]
+        return [pendulum.from_timestamp(x, tz="Asia/Shanghai") for x in dates if x]
+
+    @traced
+    def insert_book_to_notion(self, bookId, fetched=None):
+        if self.out_of_time():
+            return DEFERRED
+        try:
+            return self.write_book(bookId, fetched)
+        except MissingRelation as e:
+            print(f"::warning::{e}，这本书留到下次运行")
+            return DEFERRED
+
+    def write_book(self, bookId, fetched=None):
+        book = self.load_book(bookId, fetched)
         
         book["阅读进度"] = (100 if book.get("markedStatus") == 4 else book.get("readingProgress", 0)) / 100
         markedStatus = book.get("markedStatus")
@@ -928,7 +2469,7 @@ class WeReadSync:
         elif status == "已读":
             book["我的评分"] = "未评分"
         
-        book["时间"] = book.get("finishedDate") or book.get("lastReadingDate") or book.get("readingBookDate")
+        book["时间"] = self.book_date(book)
         book["开始阅读时间"] = book.get("beginReadingDate")
         book["最后阅读时间"] = book.get("lastReadingDate")
         
@@ -951,61 +2492,41 @@ class WeReadSync:
                 ]
         
         properties = get_properties(book, book_properties_type_dict)
-        if book.get("时间"):
+        if bookId in self.notion_books:
+            # 只发送改动过的属性，时间没变就不用重新查日期关联
+            page_id = self.notion_books.get(bookId).get("pageId")
+            properties = self.notion_helper.changed_properties(page_id, properties)
+        if book.get("时间") and "时间" in properties:
             self.notion_helper.get_date_relation(
                 properties, pendulum.from_timestamp(book.get("时间"), tz="Asia/Shanghai")
             )
         
-        print(f"正在插入《{book.get('title')}》,一共{len(books)}本，当前是第{index+1}本。")
         parent = {"database_id": self.notion_helper.book_database_id, "type": "database_id"}
         
         if bookId in self.notion_books:
-            result = self.notion_helper.update_page(
-                page_id=self.notion_books.get(bookId).get("pageId"),
-                properties=properties
-            )
+            self.notion_helper.update_book_page(page_id=page_id, properties=properties)
         else:
             result = self.notion_helper.create_book_page(parent=parent, properties=properties, icon=get_icon(BOOK_ICON_URL))
-        
-        page_id = result.get("id")
+            page_id = result.get("id")
+        records = []
         if book.get("readDetail") and book.get("readDetail").get("data"):
             data = book.get("readDetail").get("data")
             data = {item.get("readDate"): item.get("readTime") for item in data}
-            self.insert_read_data(page_id, data)
+            records = self.insert_read_data(page_id, data)
+        return book.get("title"), records
 
     def insert_read_data(self, page_id, readTimes):
-        readTimes = dict(sorted(readTimes.items()))
-        filter = {"property": "书架", "relation": {"contains": page_id}}
-        results = self.notion_helper.query_all_by_book(self.notion_helper.read_database_id, filter)
-        
-        for result in results:
-            timestamp = result.get("properties").get("时间戳").get("number")
-            duration = result.get("properties").get("时长").get("number")
-            id = result.get("id")
-            if timestamp in readTimes:
-                value = readTimes.pop(timestamp)
-                if value != duration:
-                    self.insert_to_notion(page_id=id, timestamp=timestamp, duration=value, book_database_id=page_id)
-        
-        for key, value in readTimes.items():
-            self.insert_to_notion(None, int(key), value, page_id)
-
-    def insert_to_notion(self, page_id, timestamp, duration, book_database_id):
-        parent = {"database_id": self.notion_helper.read_database_id, "type": "database_id"}
-        properties = {
-            "标题": get_title(pendulum.from_timestamp(timestamp, tz=tz).to_date_string()),
-            "日期": get_date(start=pendulum.from_timestamp(timestamp, tz=tz).format("YYYY-MM-DD HH:mm:ss")),
-            "时长": get_number(duration),
-            "时间戳": get_number(timestamp),
-            "书架": get_relation([book_database_id]),
-        }
-        if page_id:
-            self.notion_helper.client.pages.update(page_id=page_id, properties=properties)
-        else:
-            self.notion_helper.client.pages.create(parent=parent, icon=get_icon("https://www.notion.so/icons/target_red.svg"), properties=properties)
-
-    def sync_books(self):
-        self.notion_books = self.notion_helper.get_all_book()
+        """和阅读记录索引比对，返回需要新建或更新的记录，由 sync_books 在主线程放进待写入队列"""
+        index = self.notion_helper.get_read_records()
+        records = []
+        for timestamp, duration in sorted(readTimes.items()):
+            record_id, value = index.get((page_id, timestamp), (None, None))
+            if record_id is None or value != duration:
+                records.append((record_id, page_id, int(timestamp), duration))
+        return records
+
+    def books_to_sync(self):
+        """返回本分片需要同步的书，最近读过的排在前面"""
         bookshelf_books = self.weread_api.get_bookshelf()
         
         bookProgress = bookshelf_books.get("bookProgress", [])
@@ -1024,118 +2545,200 @@ class WeReadSync:
                 and (value.get("status") != "已读" or (value.get("status") == "已读" and value.get("myRating")))):
                 not_need_sync.append(key)
         
-        notebooks = self.weread_api.get_notebooklist()
-        notebooks = [d["bookId"] for d in notebooks if "bookId" in d]
+        # dimensions 还要据此找出要同步笔记的书
+        self.notebooks = self.weread_api.get_notebooklist() or []
+        notebooks = [d["bookId"] for d in self.notebooks if "bookId" in d]
         books = bookshelf_books.get("books", [])
         books = [d["bookId"] for d in books if "bookId" in d]
         books = list((set(notebooks) | set(books)) - set(not_need_sync))
-        
-        for index, bookId in enumerate(books):
-            self.insert_book_to_notion(books, index, bookId)
-
-    def get_bookmark_list(self, page_id, bookId):
-        filter = {
-            "and": [
-                {"property": "书籍", "relation": {"contains": page_id}},
-                {"property": "blockId", "rich_text": {"is_not_empty": True}},
-            ]
-        }
-        results = self.notion_helper.query_all_by_book(self.notion_helper.bookmark_database_id, filter)
-        dict1 = {get_rich_text_from_result(x, "bookmarkId"): get_rich_text_from_result(x, "blockId") for x in results}
-        dict2 = {get_rich_text_from_result(x, "blockId"): x.get("id") for x in results}
-        bookmarks = self.weread_api.get_bookmark_list(bookId)
+        books = [bookId for bookId in books if in_shard(bookId, self.shard)]
+        # 运行可能被截断，最近读过的书先同步
+        books.sort(key=lambda bookId: self.book_priority(bookId, bookProgress))
+        return books
+
+    @traced
+    def sync_books(self):
+        self.notion_books = self.notion_helper.get_all_book()
+        books = self.books_to_sync()
+        # 上次运行中断前已写完的书直接跳过，整轮同步完成后清空检查点
+        done = self.state.get_checkpoint("books")
+        if done:
+            print(f"从上次中断处继续，跳过已同步的{len(done & set(books))}本书")
+            books = [bookId for bookId in books if bookId not in done]
+        # 每批书先并发拉取，建好这批书需要的日期页面，再并发写入，写入时日期关联只查缓存；进度按书目顺序输出
+        # 阅读记录随结果返回、在这里收集，写入检查点时换下的队列不会再有线程往里追加
+        fetch = self.engine.fetch_books if self.engine else self.fetch_books
+        results = self.map_books(
+            self.insert_book_to_notion, books, fetch, lambda fetched: self.build_calendar(self.book_dates(fetched))
+        )
+        completed = []
+        deferred = 0
+        try:
+            for index, (bookId, result) in enumerate(zip(books, results)):
+                if result is DEFERRED:
+                    deferred += 1
+                    continue
+                title, records = result
+                self.read_records.extend(records)
+                print(f"正在插入《{title}》,一共{len(books)}本，当前是第{index+1}本。")
+                self.metrics.add("books")
+                completed.append(bookId)
+                if len(completed) == CHECKPOINT_BOOKS:
+                    self.save_books_checkpoint(completed)
+                    completed = []
+        except BaseException:
+            # 某本书出错或运行被取消时，已完成的书先写出缓冲再记进检查点
+            self.save_books_checkpoint(completed)
+            raise
+        finally:
+            # 阅读记录攒到最后统一写入，某本书出错时已比对好的记录照样写入
+            self.write_read_records()
+        if deferred:
+            # 时间预算用完或维度页面没建好，已完成的记进检查点，剩下的下次运行接着同步
+            print(f"::warning::还有{deferred}本书留到下次运行")
+            self.metrics.add("books_deferred", deferred)
+            self.save_books_checkpoint(completed)
+            return
+        # 全部完成后不再需要检查点，页面改动留在缓冲里和笔记阶段的 Sort 合并写入
+        self.state.clear_checkpoint("books")
+
+    def save_books_checkpoint(self, bookIds):
+        """先写出缓冲的页面改动和阅读记录，再把这些书记进检查点；页面更新失败的书不记，下次运行重新同步"""
+        failed = self.notion_helper.flush_updates(self.workers)
+        self.write_read_records()
+        self.state.add_checkpoint(
+            "books", [bookId for bookId in bookIds if self.notion_books.get(bookId, {}).get("pageId") not in failed]
+        )
+
+    def write_read_records(self):
+        if self.read_records:
+            print(f"写入阅读记录，共{len(self.read_records)}条")
+            records, self.read_records = self.read_records, []
+            self.notion_helper.write_read_records(records, self.workers)
+
+    @traced
+    def fetch_notes(self, bookId):
+        """拉取一本书的章节、划线和笔记并转成 Note，出错时返回异常，不影响其他书"""
+        try:
+            chapter = self.weread_api.get_chapter_info(bookId)
+            bookmarks = self.weread_api.get_bookmark_list(bookId)
+            reviews = self.weread_api.get_review_list(bookId)
+        except Exception as e:
+            return e
+        return parse_notes(chapter, bookmarks, reviews)
+
+    def get_bookmark_list(self, page_id, bookmarks):
+        results = self.notion_helper.get_notes("bookmark", page_id)
+        dict1 = {note_id: block_id for _, note_id, block_id in results}
+        dict2 = {block_id: row_id for row_id, _, block_id in results}
         
         for i in bookmarks:
-            if i.get("bookmarkId") in dict1:
-                i["blockId"] = dict1.pop(i.get("bookmarkId"))
-        for blockId in dict1.values():
-            self.notion_helper.delete_block(blockId)
-            self.notion_helper.delete_block(dict2.get(blockId))
+            if i.id in dict1:
+                i.block_id = dict1.pop(i.id)
+        self.notion_helper.delete_notes("bookmark", [(dict2.get(blockId), blockId) for blockId in dict1.values()])
         return bookmarks
 
-    def get_review_list(self, page_id, bookId):
-        filter = {
-            "and": [
-                {"property": "书籍", "relation": {"contains": page_id}},
-                {"property": "blockId", "rich_text": {"is_not_empty": True}},
-            ]
-        }
-        results = self.notion_helper.query_all_by_book(self.notion_helper.review_database_id, filter)
-        dict1 = {get_rich_text_from_result(x, "reviewId"): get_rich_text_from_result(x, "blockId") for x in results}
-        dict2 = {get_rich_text_from_result(x, "blockId"): x.get("id") for x in results}
-        reviews = self.weread_api.get_review_list(bookId)
+    def get_review_list(self, page_id, reviews):
+        results = self.notion_helper.get_notes("review", page_id)
+        dict1 = {note_id: block_id for _, note_id, block_id in results}
+        dict2 = {block_id: row_id for row_id, _, block_id in results}
         
         for i in reviews:
-            if i.get("reviewId") in dict1:
-                i["blockId"] = dict1.pop(i.get("reviewId"))
-        for blockId in dict1.values():
-            self.notion_helper.delete_block(blockId)
-            self.notion_helper.delete_block(dict2.get(blockId))
+            if i.id in dict1:
+                i.block_id = dict1.pop(i.id)
+        self.notion_helper.delete_notes("review", [(dict2.get(blockId), blockId) for blockId in dict1.values()])
         return reviews
 
     def sort_notes(self, page_id, chapter, bookmark_list):
-        bookmark_list = sorted(
-            bookmark_list,
-            key=lambda x: (
-                x.get("chapterUid", 1),
-                0 if (x.get("range", "") == "" or x.get("range").split("-")[0] == "") else int(x.get("range").split("-")[0]),
-            ),
-        )
+        bookmark_list.sort(key=attrgetter("sort_key"))
         
         notes = []
         if chapter:
-            filter = {"property": "书籍", "relation": {"contains": page_id}}
-            results = self.notion_helper.query_all_by_book(self.notion_helper.chapter_database_id, filter)
-            dict1 = {get_number_from_result(x, "chapterUid"): get_rich_text_from_result(x, "blockId") for x in results}
-            dict2 = {get_rich_text_from_result(x, "blockId"): x.get("id") for x in results}
+            results = self.notion_helper.get_notes("chapter", page_id)
+            # chapterUid 为空的条目没法对应章节，按条目 ID 放进去，随后当作过期条目删除
+            dict1 = {int(note_id) if note_id.isdigit() else row_id: block_id for row_id, note_id, block_id in results}
+            dict2 = {block_id: row_id for row_id, _, block_id in results}
             d = {}
             for data in bookmark_list:
-                chapterUid = data.get("chapterUid", 1)
+                chapterUid = data.chapter_uid or 1
                 if chapterUid not in d:
                     d[chapterUid] = []
                 d[chapterUid].append(data)
             for key, value in d.items():
                 if key in chapter:
+                    note = chapter.get(key)
                     if key in dict1:
-                        chapter.get(key)["blockId"] = dict1.pop(key)
-                    notes.append(chapter.get(key))
+                        note.block_id = dict1.pop(key)
+                    notes.append(note)
                 notes.extend(value)
-            for blockId in dict1.values():
-                self.notion_helper.delete_block(blockId)
-                self.notion_helper.delete_block(dict2.get(blockId))
+            self.notion_helper.delete_notes("chapter", [(dict2.get(blockId), blockId) for blockId in dict1.values()])
         else:
             notes.extend(bookmark_list)
         return notes
 
     def content_to_block(self, content):
-        if "bookmarkId" in content:
-            return get_block(
-                content.get("markText", ""), self.notion_helper.block_type,
-                self.notion_helper.show_color, content.get("style"),
-                content.get("colorStyle"), content.get("reviewId")
-            )
-        elif "reviewId" in content:
-            return get_block(
-                content.get("content", ""), self.notion_helper.block_type,
-                self.notion_helper.show_color, content.get("style"),
-                content.get("colorStyle"), content.get("reviewId")
-            )
-        else:
-            return get_heading(content.get("level"), content.get("title"))
-
-    def append_blocks_to_notion(self, id, blocks, after, contents):
-        response = self.notion_helper.append_blocks_after(block_id=id, children=blocks, after=after)
+        if content.kind == "chapter":
+            return get_heading(content.level, content.text)
+        review_id = content.id if content.kind == "review" else content.review_id
+        block = get_block(
+            content.text, self.notion_helper.block_type,
+            self.notion_helper.show_color, content.style,
+            content.color_style, review_id
+        )
+        # 原文摘录作为子块随父块一起提交，不再单独追加
+        if content.abstract:
+            block[block.get("type")]["children"] = [get_quote(content.abstract)]
+        return block
+
+    def resume_notes(self, page_id, notes):
+        """上次运行追加了块、还没写入数据库就中断的笔记沿用原来的块，返回需要补写数据库条目的笔记"""
+        pending = self.state.get_pending_notes(page_id)
+        if not pending:
+            return []
+        unsaved = []
+        for note in notes:
+            block_id = pending.pop((note.kind, str(note.id)), None)
+            if block_id and not note.block_id:
+                note.block_id = block_id
+                unsaved.append(note)
+        # 中断期间在微信读书里删掉的笔记，块已经追加了，放进删除队列
+        for (kind, note_id), block_id in pending.items():
+            self.notion_helper.delete_notes(kind, [(None, block_id)])
+        self.state.delete_pending_notes(page_id, list(pending))
+        return unsaved
+
+    def append_blocks_to_notion(self, id, blocks, anchors, contents):
+        """追加到 anchors 中最后一个锚点之后，anchors 为 (笔记, 块 ID)，第一个是目录块
+
+        锚点的块已在 Notion 里被删除时，把那条笔记当作新笔记重新追加到前一个锚点之后，再接着追加；
+        目录块也被删除时追加到页面末尾
+        """
+        after = anchors[-1][1]
+        try:
+            if after:
+                response = self.notion_helper.append_blocks_after(block_id=id, children=blocks, after=after)
+            else:
+                response = self.notion_helper.append_blocks(block_id=id, children=blocks)
+        except StaleAnchor:
+            note, _ = anchors.pop()
+            if note is None:
+                anchors.append((None, None))
+                return self.append_blocks_to_notion(id, blocks, anchors, contents)
+            print(f"::warning::《{note.text[:20]}》的块已在 Notion 里被删除，重新追加")
+            self.notion_helper.drop_note(id, note)
+            note.block_id = None
+            readded = self.append_blocks_to_notion(id, [self.content_to_block(note)], anchors, [note])
+            anchors.append((note, note.block_id))
+            return readded + self.append_blocks_to_notion(id, blocks, anchors, contents)
         results = response.get("results")
-        l = []
-        for index, content in enumerate(contents):
-            result = results[index]
-            if content.get("abstract"):
-                self.notion_helper.append_blocks(block_id=result.get("id"), children=[get_quote(content.get("abstract"))])
-            content["blockId"] = result.get("id")
-            l.append(content)
-        return l
-
-    def append_blocks(self, id, contents):
+        for content, result in zip(contents, results):
+            content.block_id = result.get("id")
+        # 块追加成功就记下，数据库条目写入前中断时下次运行不会重复追加
+        self.state.save_pending_notes(id, [(content.kind, str(content.id), content.block_id) for content in contents])
+        return list(contents)
+
+    @traced
+    def append_blocks(self, id, contents, unsaved=()):
         print(f"笔记数{len(contents)}")
         before_block_id = ""
         block_children = self.notion_helper.get_block_children(id)
@@ -1148,86 +2751,366 @@ class WeReadSync:
         
         blocks = []
         sub_contents = []
+        size = 0
         l = []
+        # 依次经过的锚点，锚点被删除时退回前一个
+        anchors = [(None, before_block_id)]
         
         for content in contents:
-            if len(blocks) == 100:
-                results = self.append_blocks_to_notion(id, blocks, before_block_id, sub_contents)
-                before_block_id = results[-1].get("blockId")
-                l.extend(results)
-                blocks.clear()
-                sub_contents.clear()
-                if not self.notion_helper.sync_bookmark and content.get("type") == 0:
-                    continue
-                blocks.append(self.content_to_block(content))
-                sub_contents.append(content)
-            elif "blockId" in content:
+            if content.block_id:
                 if len(blocks) > 0:
-                    l.extend(self.append_blocks_to_notion(id, blocks, before_block_id, sub_contents))
+                    l.extend(self.append_blocks_to_notion(id, blocks, anchors, sub_contents))
                     blocks.clear()
                     sub_contents.clear()
-                before_block_id = content["blockId"]
-            else:
-                if not self.notion_helper.sync_bookmark and content.get("type") == 0:
-                    continue
-                blocks.append(self.content_to_block(content))
-                sub_contents.append(content)
+                    size = 0
+                anchors.append((content, content.block_id))
+                continue
+            if not self.notion_helper.sync_bookmark and content.type == 0:
+                continue
+            block = self.content_to_block(content)
+            # 一次请求最多 NOTION_MAX_CHILDREN 个顶层块、NOTION_MAX_BLOCKS 个块（含子块），装不下就先提交
+            if len(blocks) == NOTION_MAX_CHILDREN or size + count_blocks(block) > NOTION_MAX_BLOCKS:
+                results = self.append_blocks_to_notion(id, blocks, anchors, sub_contents)
+                anchors.append((results[-1], results[-1].block_id))
+                l.extend(results)
+                blocks.clear()
+                sub_contents.clear()
+                size = 0
+            blocks.append(block)
+            sub_contents.append(content)
+            size += count_blocks(block)
         
         if len(blocks) > 0:
-            l.extend(self.append_blocks_to_notion(id, blocks, before_block_id, sub_contents))
+            l.extend(self.append_blocks_to_notion(id, blocks, anchors, sub_contents))
+        # 重新追加过的笔记已经在 l 里
+        l = [x for x in unsaved if x not in l] + l
         
+        if self.engine:
+            print(f"正在插入{len(l)}条笔记")
+            self.engine.create_notes(id, l)
+            return
         for index, value in enumerate(l):
             print(f"正在插入第{index+1}条笔记，共{len(l)}条")
-            if "bookmarkId" in value:
+            if value.kind == "bookmark":
                 self.notion_helper.insert_bookmark(id, value)
-            elif "reviewId" in value:
+            elif value.kind == "review":
                 self.notion_helper.insert_review(id, value)
             else:
                 self.notion_helper.insert_chapter(id, value)
 
+    @traced
     def sync_notes(self):
         notion_books = self.notion_helper.get_all_book()
+        self.notion_helper.reconcile_notes()
         books = self.weread_api.get_notebooklist()
         
-        if books:
-            for index, book in enumerate(books):
-                bookId = book.get("bookId")
-                title = book.get("book", {}).get("title")
-                sort = book.get("sort")
-                
-                if bookId not in notion_books:
-                    continue
-                if sort == notion_books.get(bookId, {}).get("Sort"):
-                    continue
-                
-                pageId = notion_books.get(bookId).get("pageId")
-                print(f"正在同步《{title}》,一共{len(books)}本，当前是第{index+1}本。")
-                
-                chapter = self.weread_api.get_chapter_info(bookId)
-                bookmark_list = self.get_bookmark_list(pageId, bookId)
-                reviews = self.get_review_list(pageId, bookId)
+        if not books:
+            return
+        tasks = self.note_tasks(notion_books, books)
+        pages = {
+            book.get("bookId"): (notion_books.get(book.get("bookId")).get("pageId"), book.get("sort"))
+            for book in tasks
+        }
+
+        # 每本书拉取完笔记就建好需要的日期页面并写入，不等其他书，时间预算用完后剩下的书不再拉取；
+        # 各书的页面互不影响，并发写入，请求速率由 NotionClient 的令牌桶统一控制
+        def sync(bookId, fetched):
+            return self.sync_book_notes(bookId, *pages[bookId], fetched)
+
+        results = self.map_books(sync, list(pages), self.engine and self.engine.fetch_notes)
+        failed = []
+        deferred = 0
+        for index, (book, error) in enumerate(zip(tasks, results)):
+            title = book.get("book", {}).get("title")
+            if error is DEFERRED:
+                deferred += 1
+            elif error:
+                print(f"::warning::《{title}》同步失败，下次运行时重试: {error}")
+                failed.append(title)
+                self.metrics.add("note_books_failed")
+            else:
+                print(f"正在同步《{title}》,一共{len(tasks)}本，当前是第{index+1}本。")
+                self.metrics.add("note_books")
+                self.state.add_checkpoint("notes", [book.get("bookId")])
+        # 各书收集到的过期笔记统一并发删除，连同以前删除失败的一起重试
+        self.notion_helper.delete_queued(self.workers)
+        # Sort 写入 Notion 后检查点就没用了
+        self.notion_helper.flush_updates(self.workers)
+        self.state.clear_checkpoint("notes")
+        if deferred:
+            print(f"::warning::还有{deferred}本书的笔记留到下次运行")
+            self.metrics.add("note_books_deferred", deferred)
+        if failed:
+            print(f"::error::{len(failed)}本书的笔记同步失败: {'、'.join(failed)}")
+
+    def note_tasks(self, notion_books, books):
+        """返回本分片笔记有改动的笔记本，笔记最近有改动的书排在前面"""
+        # 笔记逐条记在本地状态库里，写完一本就记进检查点，中断后不再重新拉取
+        done = self.state.get_checkpoint("notes")
+        tasks = []
+        for book in books:
+            bookId = book.get("bookId")
+            if bookId not in notion_books or bookId in done or not in_shard(bookId, self.shard):
+                continue
+            if book.get("sort") == notion_books.get(bookId, {}).get("Sort"):
+                continue
+            tasks.append(book)
+        tasks.sort(key=lambda book: book.get("sort") or 0, reverse=True)
+        return tasks
+
+    def note_dates(self, notes):
+        return [
+            timestamp_to_date(x.create_time)
+            for result in notes if not isinstance(result, Exception)
+            for x in result[1] + result[2]
+            if x.create_time is not None
+        ]
+
+    def build_calendar(self, dates):
+        # 分片只查不建，日期页面由 dimensions 创建
+        if self.shard:
+            return
+        if self.engine:
+            self.engine.build_calendar(dates)
+        else:
+            self.notion_helper.build_calendar(dates, self.workers)
+
+    def sync_book_notes(self, bookId, pageId, sort, fetched=None):
+        """拉取并写入一本书的笔记，再更新 Sort；出错时返回异常，Sort 保持不变以便下次重试"""
+        if self.out_of_time():
+            return DEFERRED
+        result = self.fetch_notes(bookId) if fetched is None else fetched
+        if isinstance(result, Exception):
+            return result
+        dates = self.note_dates([result])
+        # 分片同步时日期页面还没建好就先不写，免得写到一半失败
+        if self.shard and self.notion_helper.missing_days(dates):
+            print(f"::warning::{pageId} 的笔记日期页面还没有创建，请先运行 dimensions，这本书留到下次运行")
+            return DEFERRED
+        chapter, bookmark_list, reviews = result
+        try:
+            with self.metrics.span("sync_book_notes", pageId):
+                # 先建好这本书需要的日期页面，写入笔记时只查缓存
+                self.build_calendar(dates)
+                bookmark_list = self.get_bookmark_list(pageId, bookmark_list)
+                reviews = self.get_review_list(pageId, reviews)
                 bookmark_list.extend(reviews)
                 content = self.sort_notes(pageId, chapter, bookmark_list)
-                self.append_blocks(pageId, content)
+                unsaved = self.resume_notes(pageId, content)
+                self.append_blocks(pageId, content, unsaved)
                 self.notion_helper.update_book_page(page_id=pageId, properties={"Sort": get_number(sort)})
+        except Exception as e:
+            return e
+        return None
+
+    @traced
+    def sync_dimensions(self):
+        """分片同步前统一创建数据库，以及各分片要关联的作者、分类和日期页面，各分片只查不建，不会重复创建
+
+        日期取每本书的 时间 属性和要同步笔记的书里每条划线、笔记的创建日期；书籍信息和笔记列表走缓存和 synckey，
+        没有改动的书不重复下载。时间预算用完时只为已拉取的书建页面，其余的书在分片里留到下次运行
+        """
+        if self.shard:
+            raise Exception("dimensions 需要在不分片的情况下运行")
+        helper = self.notion_helper
+        self.notion_books = helper.get_all_book()
+        books = self.books_to_sync()
+
+        def load(bookId, fetched):
+            if self.out_of_time():
+                return None
+            try:
+                return self.load_book(bookId, fetched)
+            except Exception as e:
+                print(f"::warning::拉取 {bookId} 的书籍信息失败，这本书需要的页面下次运行再建: {e}")
+                return None
+
+        relations = set()
+        dates = []
+        for bookId, book in zip(books, self.map_books(load, books, self.engine and self.engine.fetch_books)):
+            if book is None:
+                continue
+            # 和 write_book 一样，作者和分类只在新建书籍页面时关联
+            if bookId not in self.notion_books:
+                relations |= {(x, helper.author_database_id, USER_ICON_URL) for x in book.get("author", "").split(" ")}
+                relations |= {
+                    (x.get("title"), helper.category_database_id, TAG_ICON_URL) for x in book.get("categories") or []
+                }
+            if self.book_date(book):
+                dates.append(pendulum.from_timestamp(self.book_date(book), tz="Asia/Shanghai"))
+
+        def notes(bookId, fetched):
+            if self.out_of_time():
+                return None
+            return self.fetch_notes(bookId) if fetched is None else fetched
+
+        # 笔记有改动的书，加上这次才新建页面的书
+        bookIds = [book.get("bookId") for book in self.note_tasks(self.notion_books, self.notebooks)]
+        bookIds += [book.get("bookId") for book in self.notebooks if book.get("bookId") not in self.notion_books]
+        results = self.map_books(notes, list(dict.fromkeys(bookIds)), self.engine and self.engine.fetch_notes)
+        dates += self.note_dates([result for result in results if result is not None])
+        if self.out_of_time():
+            print("::warning::时间预算用完，没拉取到的书在各分片里留到下次运行")
+        print(f"创建作者和分类页面，共{len(relations)}个")
+        list(map_in_pool(lambda args: helper.get_relation_id(*args), relations, self.workers))
+        self.build_calendar(dates)
 
     def run(self, mode="all"):
-        if mode in ("all", "books"):
-            print("=== 同步书籍信息 ===")
-            self.sync_books()
-        
-        if mode in ("all", "notes"):
-            print("=== 同步笔记划线 ===")
-            self.sync_notes()
+        if self.config.get("SYNC_ENGINE") == "async":
+            self.engine = AsyncEngine(self.weread_api, self.notion_helper)
+            self.engine.start()
+        if self.budget:
+            self.deadline = time.monotonic() + self.budget * (1 - TIME_BUDGET_RESERVE)
+        try:
+            if mode == "dimensions":
+                print("=== 创建作者、分类和日期页面 ===")
+                self.sync_dimensions()
+
+            if mode in ("all", "books"):
+                print("=== 同步书籍信息 ===")
+                self.sync_books()
+            
+            if mode in ("all", "notes") and self.out_of_time():
+                print("::warning::时间预算用完，笔记划线留到下次运行")
+            elif mode in ("all", "notes"):
+                print("=== 同步笔记划线 ===")
+                self.sync_notes()
+        finally:
+            # 正常结束、出错或收到 SIGTERM 时都把缓冲的页面改动写出去
+            self.notion_helper.flush_updates(self.workers)
+            if self.engine:
+                self.engine.close()
+                self.engine = None
+            self.weread_api.close()
+            self.write_metrics()
         
         print("=== 同步完成 ===")
 
+    def write_metrics(self):
+        path = self.config.get("METRICS_PATH") or METRICS_PATH
+        report = self.metrics.write(path, self.config.get("PROMETHEUS_TEXTFILE"))
+        print(f"共请求{report['requests']}次，耗时{report['seconds']:.1f}秒，统计已写入 {path}")
+
+
+def account_config(profile, base_dir):
+    """账号配置：环境变量去掉 ACCOUNT_KEYS 后用配置文件里的值覆盖，状态库和统计放在账号自己的目录下"""
+    directory = os.path.join(base_dir, profile["name"])
+    config = {k: v for k, v in os.environ.items() if k not in ACCOUNT_KEYS + ("PROMETHEUS_TEXTFILE",)}
+    config["STATE_PATH"] = os.path.join(directory, "state.db")
+    config["METRICS_PATH"] = os.path.join(directory, "metrics.json")
+    config.update({k: str(v) for k, v in profile.items()})
+    return config
+
+
+def sync_accounts(path, mode="all", workers=ACCOUNT_CONCURRENCY):
+    """按配置文件同时同步多个账号，各账号单独统计，一个账号失败不影响其他账号
+
+    配置文件是 JSON 数组，每项至少包含 name、WEREAD_COOKIE（或 CC_ID、CC_PASSWORD）、NOTION_TOKEN 和 NOTION_PAGE，
+    其他键和环境变量同名，用来覆盖该账号的配置
+    """
+    with open(path, encoding="utf-8") as f:
+        profiles = json.load(f)
+    names = [profile.get("name") for profile in profiles]
+    if not all(names) or len(set(names)) != len(names):
+        raise Exception(f"{path} 中每个账号都需要不重复的 name")
+    base_dir = os.path.dirname(os.getenv("STATE_PATH", STATE_PATH))
+
+    def sync(profile):
+        name = profile["name"]
+        config = account_config(profile, base_dir)
+        metrics = Metrics()
+        result = {"name": name, "status": "ok"}
+        print(f"=== 开始同步账号 {name} ===")
+        try:
+            WeReadSync(metrics, config).run(mode)
+        except Exception as e:
+            print(f"::error::账号 {name} 同步失败: {e}")
+            result.update(status="failed", error=str(e))
+        report = metrics.report()
+        result.update(seconds=report["seconds"], requests=report["requests"], counters=report["counters"])
+        return result
+
+    results = list(map_in_pool(sync, profiles, workers))
+    print("=== 各账号同步结果 ===")
+    for result in results:
+        counters = result["counters"]
+        print(
+            f"{result['name']}: {'成功' if result['status'] == 'ok' else '失败'}，"
+            f"书籍{counters.get('books', 0)}本，笔记{counters.get('note_books', 0)}本，"
+            f"请求{result['requests']}次，耗时{result['seconds']:.1f}秒"
+            + (f"，错误: {result['error']}" if "error" in result else "")
+        )
+    report_path = os.path.join(base_dir, "accounts.json")
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"各账号结果已写入 {report_path}")
+    return results
+
 # ==================== 主程序入口 ====================
 
+def profile_run(func, path):
+    """用 cProfile 运行 func，工作线程各用一个 profiler，结束后合并写入 path 并打印累计耗时最多的函数"""
+    profiles = [cProfile.Profile()]
+
+    def profile_thread(frame, event, arg):
+        profile = cProfile.Profile()
+        profiles.append(profile)
+        profile.enable()
+
+    threading.setprofile(profile_thread)
+    profiles[0].enable()
+    try:
+        return func()
+    finally:
+        profiles[0].disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(*profiles)
+        stats.dump_stats(path)
+        stats.sort_stats("cumulative").print_stats(30)
+        print(f"性能分析已写入 {path}，可用 python -m pstats 或 snakeviz 查看")
+
+
 if __name__ == "__main__":
-    import sys
-    mode = "all"
-    if len(sys.argv) > 1:
-        mode = sys.argv[1]
-    sync = WeReadSync()
-    sync.run(mode)
+    parser = argparse.ArgumentParser(description="微信读书 → Notion 同步")
+    parser.add_argument("mode", nargs="?", default="all", choices=("all", "books", "notes", "dimensions"))
+    parser.add_argument("--trace", metavar="PATH", help="把各阶段和每本书的耗时写成 Chrome trace 文件")
+    parser.add_argument("--profile", metavar="PATH", help="用 cProfile 运行并把统计写入 PATH")
+    parser.add_argument("--refresh", action="store_true", help="忽略本地缓存，重新拉取书籍信息和章节")
+    parser.add_argument("--time-budget", type=float, metavar="SECONDS", help="运行时间上限，快用完时停止开始新的书，剩下的留到下次运行")
+    parser.add_argument("--accounts", metavar="PATH", help="按 JSON 配置文件同时同步多个账号")
+    parser.add_argument(
+        "--account-workers", type=int, default=int(os.getenv("ACCOUNT_CONCURRENCY", ACCOUNT_CONCURRENCY)),
+        metavar="N", help="多账号同步时同时进行的账号数",
+    )
+    parser.add_argument(
+        "--shard", metavar="i/N",
+        help="按 bookId 哈希只同步第 i 个分片（共 N 个），Notion 限速按 N 平分；需要先运行 dimensions",
+    )
+    args = parser.parse_args()
+    if args.accounts and args.trace:
+        parser.error("--trace 只支持单个账号")
+    if args.shard:
+        try:
+            parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+        os.environ["SYNC_SHARD"] = args.shard
+    if args.refresh:
+        os.environ["WEREAD_REFRESH"] = "1"
+    if args.time_budget:
+        os.environ["SYNC_TIME_BUDGET"] = str(args.time_budget)
+    # GitHub Actions 取消任务时发送 SIGTERM，转成 SystemExit 让 run 的 finally 有机会写出缓冲
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    metrics = Metrics(trace=bool(args.trace))
+    if args.accounts:
+        run = lambda: sync_accounts(args.accounts, args.mode, args.account_workers)
+    else:
+        run = lambda: WeReadSync(metrics).run(args.mode)
+    try:
+        result = profile_run(run, args.profile) if args.profile else run()
+        if args.accounts and any(x["status"] != "ok" for x in result):
+            sys.exit(1)
+    finally:
+        if args.trace:
+            metrics.write_trace(args.trace)
+            print(f"追踪数据已写入 {args.trace}，可在 chrome://tracing 或 https://ui.perfetto.dev 打开")